@@ -128,13 +128,14 @@ def unpack(args):
         path = maps[d]['texture_path'].format(**dict(conf, **maps[d]))
         if os.path.isdir(path):
             output = os.path.join(conf['output_root'], 'texture', d)
-            tl = texture.TextureLibrary(texture_path=[output])
+            packs = []
             for name in os.listdir(path):
                 for pattern in maps[d]['texture_files']:
                     if re.match(pattern, name):
-                        tl.add_pack(os.path.join(path, name))
+                        packs.append(os.path.join(path, name))
                         break
-            tl.save_all(output, parallel)
+            texture.unpack_packs(packs, output, parallel,
+                                 conf.get('texture_atlas', False))
         else:
             print('invalid texture_path: {}'.format(path))
 
@@ -211,7 +212,9 @@ def render_map(cmd, conf, maps, map_name, map_type=None):
     options['cache_name'] = map_name
     dep = get_dep(conf, maps, [map_name, 'default'])
     options['texture'] = []
-    for d in dep:
+    # sorted, the plant textures are kept in the first folder, see
+    # TextureLibrary.config_plants
+    for d in sorted(dep):
         texture_path = os.path.join(conf['output_root'], 'texture', d)
         if os.path.isdir(texture_path):
             options['texture'].append(texture_path)
@@ -309,6 +312,8 @@ def render_saves(cmd, conf, maps, map_name):
 
 def render(args):
     conf, maps = parse_map(args.conf)
+    if args.verify:
+        conf['render_conf']['verify_tiles'] = True
     for cmd in args.args:
         # base map
         if conf.get('base_map'):
@@ -383,6 +388,8 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='pzmap2dzi render')
     parser.add_argument('-c', '--conf', type=str, default='conf/conf.yaml')
+    parser.add_argument('--verify', action='store_true',
+                        help='check existing tiles against their manifest')
     parser.add_argument('cmd', type=str)
     parser.add_argument('args', nargs=argparse.REMAINDER)
     args = parser.parse_args()
@@ -1,17 +1,19 @@
+import array
 from . import util
 
 
-def get_version(data, pos, magic, default):
-    next_pos = pos + len(magic)
-    if data[pos: next_pos] == magic:
-        return util.read_uint32(data, next_pos)
+def get_version(reader, magic, default):
+    # reader: util.BinaryReader, default: a value or a callable reading
+    # the version from the reader when the magic is absent
+    if reader.match(magic):
+        return reader.uint32()
     elif callable(default):
-        return default(data, pos)
+        return default(reader)
     else:
         return default
 
 
-def read_block(data, pos, block_size, layer_range, data_parser):
+def read_block(reader, block_size, layer_range, data_parser):
     square_per_layer = block_size * block_size
     skip = 0
     minlayer, maxlayer = layer_range
@@ -30,98 +32,118 @@ def read_block(data, pos, block_size, layer_range, data_parser):
                 if skip > 0:
                     skip -= 1
                     continue
-                count, pos = util.read_int32(data, pos)
+                count = reader.int32()
                 if count == -1:
-                    skip, pos = util.read_int32(data, pos)
+                    skip = reader.int32()
                     if skip > 0:
                         skip -= 1
                         continue
                 if count > 1:
-                    row_data[y], pos = data_parser(data, pos, count - 1)
+                    row_data[y] = data_parser(reader, count - 1)
             if row_data != [None] * block_size:
                 layer_data[x] = row_data
         if layer_data != [None] * block_size:
             block_data[z] = layer_data
-    return block_data, pos
+    return block_data
+
+
+def read_block_flat(ints, idx, block_size, layer_range, decode_range=None):
+    # decode a lotpack block from an int32 array (see util.read_int32_array)
+    # into CSR-style flat arrays:
+    #     tiles[offsets[i]: offsets[i + 1]] are the tile ids of square i
+    #     i = ((layer - decode_min) * block_size + x) * block_size + y
+    # only layers in decode_range (default: layer_range) are kept and
+    # decoding stops after them, so the returned idx is only meaningful
+    # when the whole layer_range is decoded
+    # room ids are dropped as they are not used
+    minlayer, maxlayer = layer_range
+    lo, hi = decode_range if decode_range else layer_range
+    lo = min(max(lo, minlayer), maxlayer)
+    hi = min(max(hi, lo), maxlayer)
+    square_per_layer = block_size * block_size
+    begin = (lo - minlayer) * square_per_layer
+    end = (hi - minlayer) * square_per_layer
+    offsets = array.array('i', [0]) * (end - begin + 1)
+    tiles = array.array('i')
+    square = 0
+    while square < end:
+        count = ints[idx]
+        idx += 1
+        if count == -1:
+            skip = ints[idx]
+            idx += 1
+            if skip > 1:
+                stop = min(square + skip, end)
+                if stop > begin:
+                    start = max(square, begin)
+                    offsets[start - begin + 1: stop - begin + 1] = (
+                        array.array('i', [len(tiles)]) * (stop - start))
+                square = stop
+                continue
+        elif count > 1:
+            if square >= begin:
+                tiles.extend(ints[idx + 1: idx + count])
+            idx += count
+        square += 1
+        if square > begin:
+            offsets[square - begin] = len(tiles)
+    return (offsets, tiles), idx
 
 
-def read_tile_defs(data, pos):
-    tile_name_num, pos = util.read_uint32(data, pos)
-    tile_names = []
-    for i in range(tile_name_num):
-        name, pos = util.read_line(data, pos)
-        tile_names.append(name.decode('utf8').strip())
-    return tile_names, pos
+def read_tile_defs(reader):
+    lines = reader.lines(reader.uint32())
+    return [line.decode('utf8').strip() for line in lines]
 
 
 def calc_room_bound(room):
-    for rect in room['rects']:
-        x, y, w, h = rect
-        room['xmin'] = min(room.get('xmin', x), x)
-        room['xmax'] = max(room.get('xmax', x + w), x + w)
-        room['ymin'] = min(room.get('ymin', y), y)
-        room['ymax'] = max(room.get('ymax', y + h), y + h)
+    rects = room['rects']
+    if rects:
+        room['xmin'] = min(x for x, y, w, h in rects)
+        room['xmax'] = max(x + w for x, y, w, h in rects)
+        room['ymin'] = min(y for x, y, w, h in rects)
+        room['ymax'] = max(y + h for x, y, w, h in rects)
 
 
-def read_room(data, pos):
+def read_room(reader):
     room = {}
-    name, pos = util.read_line(data, pos)
-    room['name'] = name
-    room['layer'], pos = util.read_int32(data, pos)
-    rect_num, pos = util.read_uint32(data, pos)
-    rects = []
-    room['area'] = 0
-    for i in range(rect_num):
-        x, pos = util.read_int32(data, pos)
-        y, pos = util.read_int32(data, pos)
-        w, pos = util.read_int32(data, pos)
-        h, pos = util.read_int32(data, pos)
-        room['area'] += w * h
-        rects.append((x, y, w, h))
+    room['name'] = reader.line()
+    room['layer'] = reader.int32()
+    rects = reader.records('i', 4, reader.uint32())
+    room['area'] = sum(w * h for x, y, w, h in rects)
     room['rects'] = rects
 
     calc_room_bound(room)
 
-    meta_num, pos = util.read_uint32(data, pos)
-    metas = []
-    for i in range(meta_num):
-        meta_type, pos = util.read_int32(data, pos)
-        x, pos = util.read_int32(data, pos)  # relative to file base
-        y, pos = util.read_int32(data, pos)
-        metas.append((meta_type, x, y))
-    room['objects'] = metas
+    # (type, x, y), x and y are relative to file base
+    room['objects'] = reader.records('i', 3, reader.uint32())
 
-    return room, pos
+    return room
 
 
-def read_rooms(data, pos):
-    room_num, pos = util.read_uint32(data, pos)
+def read_rooms(reader):
+    room_num = reader.uint32()
     rooms = []
     for i in range(room_num):
-        room, pos = read_room(data, pos)
+        room = read_room(reader)
         room['id'] = i
         rooms.append(room)
-    return rooms, pos
+    return rooms
 
 
-def read_building(data, pos):
+def read_building(reader):
     building = {}
-    room_num, pos = util.read_uint32(data, pos)
-    building['rooms'] = []
-    for i in range(room_num):
-        room_id, pos = util.read_uint32(data, pos)
-        building['rooms'].append(room_id)
-    return building, pos
+    building['rooms'] = list(reader.values('I', reader.uint32()))
+    return building
 
 
-def read_buildings(data, pos):
-    building_num, pos = util.read_uint32(data, pos)
+def read_buildings(reader):
+    building_num = reader.uint32()
     buildings = []
     for i in range(building_num):
-        building, pos = read_building(data, pos)
+        building = read_building(reader)
         building['id'] = i
         buildings.append(building)
-    return buildings, pos
+    return buildings
 
 
 def load_pzby(path):
@@ -129,52 +151,49 @@ def load_pzby(path):
     pzby = {}
     with open(path, 'rb') as f:
         data = f.read()
+    reader = util.BinaryReader(data)
 
     pzby['path'] = path
-    pzby['version'], pos = get_version(data, 0, b'PZBY', (None, 0))
+    pzby['version'] = get_version(reader, b'PZBY', None)
     if pzby['version'] is None:
         return None
 
     # header
-    pzby['tiles'], pos = read_tile_defs(data, pos)
-    pzby['width'], pos = util.read_int32(data, pos)
-    pzby['height'], pos = util.read_int32(data, pos)
-    pzby['layers'], pos = util.read_int32(data, pos)
+    pzby['tiles'] = read_tile_defs(reader)
+    pzby['width'], pzby['height'], pzby['layers'] = reader.values('i', 3)
 
-    pzby['rooms'], pos = read_rooms(data, pos)
-    pzby['buildings'], pos = read_buildings(data, pos)
+    pzby['rooms'] = read_rooms(reader)
+    pzby['buildings'] = read_buildings(reader)
 
     # chunks
-    block_table = pos
+    block_num = pzby['width'] * pzby['height']
+    # (offset, padding) pairs
+    block_offsets = reader.values('I', 2 * block_num)[::2]
     block_size = 8
     blocks = []
     layer_range = [0, pzby['layers']]
     attributes = []
-    for i in range(pzby['width'] * pzby['height']):
-        pos, _ = util.read_uint32(data, block_table + i * 8)
-        attribute, pos = read_block(
-            data, pos, block_size, layer_range, pzby_attributes_parser)
+    for offset in block_offsets:
+        reader.seek(offset)
+        attribute = read_block(
+            reader, block_size, layer_range, pzby_attributes_parser)
         attributes.append(attribute)
-        block, pos = read_block(
-            data, pos, block_size, layer_range, pzby_data_parser)
+        block = read_block(
+            reader, block_size, layer_range, pzby_data_parser)
         blocks.append(block)
     pzby['attrib'] = attributes
     pzby['blocks'] = blocks
     return pzby
 
 
-def pzby_attributes_parser(data, pos, count):
-    return util.read_int32(data, pos)
+def pzby_attributes_parser(reader, count):
+    return reader.int32()
 
 
-def pzby_data_parser(data, pos, count):
-    tiles = []
-    for i in range(count):
-        tile, pos = util.read_int32(data, pos)
-        tiles.append(tile)
-    return tiles, pos
+def pzby_data_parser(reader, count):
+    return list(reader.values('i', count))
 
 
-def lotpack_data_parser(data, pos, count):
-    room, pos = util.read_int32(data, pos)  # drop room id as it is not used
-    return pzby_data_parser(data, pos, count)
+def lotpack_data_parser(reader, count):
+    reader.skip(4)  # drop room id as it is not used
+    return pzby_data_parser(reader, count)
@@ -1,29 +1,50 @@
 import os
+import mmap
 from . import binfile, lotheader, util
 
 
 class Cell(object):
-    def __init__(self, path, header):
+    def __init__(self, path, header, lazy=False, layer_range=None):
+        # lazy: mmap the lotpack and decode blocks on first access
+        # layer_range: [min, max) layers to decode, default all layers
         self.header = header
         self.path = path
         self.x = header['x']
         self.y = header['y']
-        data = b''
-        with open(path, 'rb') as f:
-            data = f.read()
-        self.version, pos = binfile.get_version(data, 0, b'LOTP', (0, 0))
-        self.init_for_version()
-        block_num, pos = util.read_uint32(data, pos)
-        self.blocks = []
-        block_table = pos
-        for i in range(block_num):
-            pos, _ = util.read_uint32(data, block_table + i * 8)
-            block, pos = binfile.read_block(
-                data, pos, self.block_size, [self.minlayer, self.maxlayer],
-                binfile.lotpack_data_parser)
-            self.blocks.append(block)
-
-    def init_for_version(self):
+        self.lazy = lazy
+        # per-cell lookup tables indexed by tile id, built by renderers
+        self.remaps = {}
+        if lazy:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        reader = util.BinaryReader(data)
+        self.version = binfile.get_version(reader, b'LOTP', 0)
+        self.init_for_version(layer_range)
+        block_num = reader.uint32()
+        # (offset, padding) pairs
+        self.block_offsets = list(reader.values('I', 2 * block_num)[::2])
+        # lotpack content is int32 aligned, decode it in bulk
+        if lazy:
+            self.ints = util.int32_view(data)
+            self.blocks = [None] * block_num
+        else:
+            self.ints = util.read_int32_array(data)
+            self.blocks = [self.load_block(i) for i in range(block_num)]
+            self.ints = None
+
+    def load_block(self, index):
+        block, _ = binfile.read_block_flat(
+            self.ints, self.block_offsets[index] >> 2, self.block_size,
+            [self.minlayer, self.maxlayer],
+            [self.decode_minlayer, self.decode_maxlayer])
+        if self.lazy:
+            self.blocks[index] = block
+        return block
+
+    def init_for_version(self, layer_range=None):
         if self.version != self.header['version']:
             raise Exception('Inconsistent version: H:{} P:{} path:{}'.format(
                             self.header['version'], self.version, self.path))
@@ -32,33 +53,104 @@ class Cell(object):
         self.cell_size = self.block_per_cell * self.block_size
         self.minlayer = self.header['minlayer']
         self.maxlayer = self.header['maxlayer']
+        self.decode_minlayer = self.minlayer
+        self.decode_maxlayer = self.maxlayer
+        if layer_range:
+            self.decode_minlayer = max(self.minlayer, layer_range[0])
+            self.decode_maxlayer = min(self.maxlayer, layer_range[1])
 
-    def get_square(self, subx, suby, layer):
-        if layer < self.minlayer or layer >= self.maxlayer:
+    def layer_offset(self, layer):
+        # index of square (0, 0) of a layer in a block, None if not decoded
+        if layer < self.decode_minlayer or layer >= self.decode_maxlayer:
+            return None
+        return (layer - self.decode_minlayer) * self.block_size * self.block_size
+
+    def get_block(self, index):
+        # (offsets, tiles) of a block, see binfile.read_block_flat
+        block = self.blocks[index]
+        if block is None:
+            block = self.load_block(index)
+        return block
+
+    def occupied_rects(self):
+        # {layer: [(sx, sy, w, h), ...]} square rects covering the blocks
+        # with tiles on each decoded layer
+        # runs of blocks along y are merged with the same run of the
+        # previous block column, so a fully occupied layer is a single rect
+        square_per_layer = self.block_size * self.block_size
+        layers = range(self.decode_minlayer, self.decode_maxlayer)
+        bpc = self.block_per_cell
+        rects = {}
+        last = {}  # (layer, by1, by2) -> [bx1, by1, bx2, by2]
+
+        def close_run(layer, bx, by1, by2):
+            rect = last.get((layer, by1, by2))
+            if rect is not None and rect[2] == bx - 1:
+                rect[2] = bx
+                return
+            rect = [bx, by1, bx, by2]
+            last[(layer, by1, by2)] = rect
+            rects.setdefault(layer, []).append(rect)
+
+        for bx in range(bpc):
+            runs = {}  # layer -> start of the current run
+            for by in range(bpc):
+                offsets, tiles = self.get_block(bx * bpc + by)
+                if len(tiles) == 0:
+                    for layer in list(runs):
+                        close_run(layer, bx, runs.pop(layer), by - 1)
+                    continue
+                for layer in layers:
+                    i = self.layer_offset(layer)
+                    if offsets[i] != offsets[i + square_per_layer]:
+                        runs.setdefault(layer, by)
+                    elif layer in runs:
+                        close_run(layer, bx, runs.pop(layer), by - 1)
+            for layer, by1 in runs.items():
+                close_run(layer, bx, by1, bpc - 1)
+        sx0 = self.x * self.cell_size
+        sy0 = self.y * self.cell_size
+        bs = self.block_size
+        for layer, blocks in rects.items():
+            rects[layer] = [(sx0 + bx1 * bs, sy0 + by1 * bs,
+                             (bx2 - bx1 + 1) * bs, (by2 - by1 + 1) * bs)
+                            for bx1, by1, bx2, by2 in blocks]
+        return rects
+
+    def get_square_ids(self, subx, suby, layer):
+        # tile ids are indices of self.header['tiles']
+        i = self.layer_offset(layer)
+        if i is None:
             return None
         bx, x = divmod(subx, self.block_size)
         by, y = divmod(suby, self.block_size)
-        block = self.blocks[bx * self.block_per_cell + by]
-        layer = block[layer]
-        if not layer:
+        offsets, tiles = self.get_block(bx * self.block_per_cell + by)
+        i += x * self.block_size + y
+        begin = offsets[i]
+        end = offsets[i + 1]
+        if begin == end:
             return None
-        row = layer[x]
-        if not row:
-            return None
-        tiles = row[y]
-        if not tiles:
+        return tiles[begin: end]
+
+    def get_square(self, subx, suby, layer):
+        tiles = self.get_square_ids(subx, suby, layer)
+        if tiles is None:
             return None
-        return map(lambda t: self.header['tiles'][t], tiles)
+        names = self.header['tiles']
+        return [names[t] for t in tiles]
 
 
-def load_cell(path, x, y):
+def load_cell(path, x, y, lazy=False, layer_range=None, cache=None):
     header = lotheader.load_lotheader(path, x, y)
     if not header:
         return None
     lotpack_name = os.path.join(path, 'world_{}_{}.lotpack'.format(x, y))
     if not os.path.isfile(lotpack_name):
         return None
-    return Cell(lotpack_name, header)
+    if cache is not None:
+        # cached cells are memory mapped and always have all layers
+        return cache.load(lotpack_name, header)
+    return Cell(lotpack_name, header, lazy, layer_range)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import os
+import mmap
+import struct
+from . import cell, util, source_manager
+
+# cached cell file layout (native int32):
+#     magic 'PZCC', version, signature length, signature (padded to 4 bytes)
+#     block_num, square_per_block (all layers), minlayer, maxlayer
+#     tile start index of each block, (block_num + 1) ints
+#     square offsets of each block, block_num * (square_per_block + 1) ints
+#     tile ids
+MAGIC = b'PZCC'
+VERSION = 1
+
+
+def cell_signature(lotpack, header, hash_algo=None):
+    lotheader = os.path.join(header['path'], '{}_{}.lotheader'.format(
+        header['x'], header['y']))
+    return source_manager.stat_signature([lotheader, lotpack], hash_algo)
+
+
+def read_signature(data):
+    if data[0: 4] != MAGIC:
+        return None, 0
+    version, pos = util.read_uint32(data, 4)
+    if version != VERSION:
+        return None, 0
+    signature, pos = util.read_bytes_with_length(data, pos)
+    pos += -pos & 3
+    return signature.decode('utf8'), pos
+
+
+class CachedCell(cell.Cell):
+    def __init__(self, path, header, data, pos):
+        self.header = header
+        self.path = path
+        self.x = header['x']
+        self.y = header['y']
+        self.lazy = False
+        self.remaps = {}
+        self.version = header['version']
+        self.init_for_version()
+        ints = util.int32_view(data)
+        i = pos >> 2
+        block_num, square_per_block, minlayer, maxlayer = ints[i: i + 4]
+        layers = self.maxlayer - self.minlayer
+        if (block_num != self.block_per_cell ** 2 or
+                square_per_block != layers * self.block_size ** 2 or
+                minlayer != self.minlayer or maxlayer != self.maxlayer):
+            raise ValueError('Cached cell mismatch: {}'.format(path))
+        i += 4
+        starts = ints[i: i + block_num + 1]
+        i += block_num + 1
+        tiles = i + block_num * (square_per_block + 1)
+        self.blocks = []
+        for b in range(block_num):
+            offsets = ints[i: i + square_per_block + 1]
+            i += square_per_block + 1
+            self.blocks.append(
+                (offsets, ints[tiles + starts[b]: tiles + starts[b + 1]]))
+        self.ints = None
+
+
+class CellCache(object):
+    def __init__(self, path, hash_algo=None):
+        self.path = path
+        self.hash_algo = hash_algo
+        util.ensure_folder(path)
+
+    def cache_path(self, x, y):
+        return os.path.join(self.path, '{}_{}.cell'.format(x, y))
+
+    def load_cached(self, lotpack, header, signature):
+        path = self.cache_path(header['x'], header['y'])
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            cached, pos = read_signature(data)
+            if cached != signature:
+                return None
+            return CachedCell(lotpack, header, data, pos)
+        except Exception as e:
+            return None
+
+    def save(self, c, signature):
+        signature = signature.encode('utf8')
+        padding = b'\x00' * (-len(signature) & 3)
+        starts = [0]
+        for offsets, tiles in c.blocks:
+            starts.append(starts[-1] + len(tiles))
+        layers = c.maxlayer - c.minlayer
+        square_per_block = layers * c.block_size * c.block_size
+        path = self.cache_path(c.x, c.y)
+        tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('II', VERSION, len(signature)))
+                f.write(signature + padding)
+                f.write(struct.pack('iiii', len(c.blocks), square_per_block,
+                                    c.minlayer, c.maxlayer))
+                f.write(struct.pack('{}i'.format(len(starts)), *starts))
+                for offsets, tiles in c.blocks:
+                    f.write(offsets.tobytes())
+                for offsets, tiles in c.blocks:
+                    f.write(tiles.tobytes())
+            if os.path.isfile(path):
+                os.remove(path)
+            # may fail if another worker has written the same cell
+            os.rename(tmp_path, path)
+        except Exception as e:
+            pass
+        if os.path.isfile(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception as e:
+                pass
+
+    def load(self, lotpack, header):
+        signature = cell_signature(lotpack, header, self.hash_algo)
+        c = self.load_cached(lotpack, header, signature)
+        if c is not None:
+            return c
+        c = cell.Cell(lotpack, header)
+        self.save(c, signature)
+        cached = self.load_cached(lotpack, header, signature)
+        return c if cached is None else cached
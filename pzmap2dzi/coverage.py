@@ -0,0 +1,49 @@
+import os
+from . import lotheader, mptask
+
+# missing textures of a render, written to its output folder
+REPORT_NAME = 'missing_textures.txt'
+
+
+class CellTiles(object):
+    # number of cells using each tile name, for a group of cells
+    def __init__(self, path):
+        self.path = path
+
+    def on_job(self, cells):
+        counts = {}
+        for x, y in cells:
+            header = lotheader.load_lotheader(self.path, x, y)
+            if header:
+                for name in set(header['tiles']):
+                    counts[name] = counts.get(name, 0) + 1
+        return counts
+
+
+def tile_counts(path, cells, parallel=1, verbose=False):
+    # {tile name: number of cells using it} from the lotheaders of cells
+    cells = sorted(cells)
+    worker = CellTiles(path)
+    if parallel > 1 and len(cells) > parallel:
+        jobs = mptask.split_list(cells, parallel * 4)
+        results = mptask.Task(worker, verbose).run(jobs, parallel)
+    else:
+        results = [worker.on_job(cells)]
+    counts = {}
+    for result in results:
+        if not result:
+            continue
+        for name, count in result.items():
+            counts[name] = counts.get(name, 0) + count
+    return counts
+
+
+def missing_tiles(tl, names):
+    return sorted(name for name in names if not tl.has_texture(name))
+
+
+def save_report(path, missing, counts):
+    with open(path, 'w') as f:
+        f.write('# missing texture, number of cells using it\n')
+        for name in missing:
+            f.write('{} {}\n'.format(name, counts.get(name, 0)))
@@ -0,0 +1,212 @@
+import os
+import time
+import sqlite3
+import hashlib
+import importlib
+import threading
+from PIL import Image
+
+# render time deduplication of tiles with hardlinks, see
+# docs/designs/dedup.md
+# tiles are hashed from the raw RGBA buffer before encoding, a tile with
+# the same hash, format and save options as a recorded file is hardlinked
+# to it and never encoded
+DB_NAME = 'dedup.db'
+DEFAULT_HASH = 'xxhash.xxh64'
+PENDING = b'-1'  # inode of a file being written
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS mapping_table ('
+    'hash BLOB, id INTEGER, path TEXT, inode BLOB, state INTEGER)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS mapping_hash_id '
+    'ON mapping_table (hash, id)',
+    'CREATE INDEX IF NOT EXISTS mapping_path ON mapping_table (path)',
+    'CREATE INDEX IF NOT EXISTS mapping_inode ON mapping_table (inode)',
+    'CREATE TABLE IF NOT EXISTS meta_table ('
+    'hash_algorithm TEXT, collision_count INTEGER, last_updated TIMESTAMP)',
+]
+
+
+def hash_factory(name):
+    # (name, factory) of 'module.function' (e.g. xxhash.xxh64) or a hashlib
+    # algorithm name, the name is md5 when it falls back to md5
+    if '.' in name:
+        module_name, func_name = name.rsplit('.', 1)
+        try:
+            return name, getattr(importlib.import_module(module_name),
+                                 func_name)
+        except (ImportError, AttributeError) as e:
+            print('Hash function {} not found, use md5'.format(name))
+            return 'md5', hashlib.md5
+    return name, lambda: hashlib.new(name)
+
+
+def is_lossless(ext, options):
+    return ext == 'png' or (ext == 'webp' and options.get('lossless'))
+
+
+def file_inode(path):
+    return str(os.stat(path).st_ino).encode('utf8')
+
+
+def temp_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, '~{}.{}.{}'.format(
+        os.getpid(), threading.current_thread().ident, name))
+
+
+def replace_file(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+class Dedup(object):
+    # shared by the worker processes and their writer threads, each
+    # process opens its own connection on first use
+    def __init__(self, path, hash_name=DEFAULT_HASH, save_options=None):
+        self.path = path
+        # resolved once here, hash_name is the algorithm recorded in
+        # meta_table and used by the workers
+        self.hash_name, self.hash = hash_factory(hash_name or DEFAULT_HASH)
+        self.save_options = save_options or {}
+        self.db = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stats = [0, 0]  # linked, written
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['db'] = None
+        state['pid'] = None
+        state['lock'] = None
+        state['hash'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.hash_name, self.hash = hash_factory(self.hash_name)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # called with the lock held
+        if self.db is not None and self.pid == os.getpid():
+            return self.db
+        self.pid = os.getpid()
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('BEGIN IMMEDIATE')
+        for sql in SCHEMA:
+            db.execute(sql)
+        row = db.execute('SELECT hash_algorithm FROM meta_table').fetchone()
+        if row is None:
+            db.execute('INSERT INTO meta_table VALUES (?, 0, ?)',
+                       (self.hash_name, time.time()))
+        elif row[0] != self.hash_name:
+            # hashes of another algorithm can not be matched
+            print('Dedup hash changed from {} to {}, mapping reset'.format(
+                row[0], self.hash_name))
+            db.execute('DELETE FROM mapping_table')
+            db.execute('UPDATE meta_table SET hash_algorithm = ?, '
+                       'collision_count = 0', (self.hash_name,))
+        db.execute('UPDATE meta_table SET last_updated = ?', (time.time(),))
+        db.execute('COMMIT')
+        self.db = db
+        return db
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.connect().execute(sql, args).fetchall()
+
+    def close(self):
+        # a connection must not be carried over to forked workers
+        with self.lock:
+            if self.db is not None and self.pid == os.getpid():
+                self.db.close()
+            self.db = None
+
+    def digest(self, im, ext):
+        h = self.hash()
+        options = sorted(self.save_options.get(ext, {}).items())
+        h.update('{} {} {} {}\n'.format(
+            ext, options, im.mode, im.size).encode('utf8'))
+        h.update(im.tobytes())
+        return h.digest()
+
+    def insert(self, digest, path, inode):
+        while True:
+            try:
+                self.execute(
+                    'INSERT INTO mapping_table SELECT ?, '
+                    'COALESCE(MAX(id), 0) + 1, ?, ?, 0 FROM mapping_table '
+                    'WHERE hash = ?', (digest, path, inode, digest))
+                return
+            except sqlite3.IntegrityError as e:
+                continue  # same id taken by another process
+
+    def count(self, i):
+        with self.lock:
+            self.stats[i] += 1
+
+    def forget(self, path):
+        self.execute('DELETE FROM mapping_table WHERE path = ?', (path,))
+
+    def same_pixels(self, im, src):
+        try:
+            with Image.open(src) as stored:
+                if stored.size != im.size:
+                    return False
+                stored = stored.convert(im.mode)
+                return stored.tobytes() == im.tobytes()
+        except Exception as e:
+            return False
+
+    def link(self, src, path):
+        tmp = temp_path(path)
+        try:
+            os.link(src, tmp)
+            replace_file(tmp, path)
+            return True
+        except Exception as e:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return False
+
+    def save(self, im, ext, path, encode):
+        # link path to a recorded file of the same tile, or write it with
+        # encode(im, path) and record it
+        # returns the result of encode, None when linked
+        digest = self.digest(im, ext)
+        self.forget(path)
+        verify = is_lossless(ext, self.save_options.get(ext, {}))
+        rows = self.execute(
+            'SELECT id, path, inode FROM mapping_table WHERE hash = ? AND '
+            'inode != ? ORDER BY id DESC', (digest, PENDING))
+        for row_id, src, inode in rows:
+            try:
+                valid = file_inode(src) == inode
+            except OSError as e:
+                valid = False
+            if not valid:
+                # replaced or removed outside of dedup
+                self.execute('DELETE FROM mapping_table WHERE hash = ? AND '
+                             'id = ?', (digest, row_id))
+                continue
+            if verify and not self.same_pixels(im, src):
+                self.execute('UPDATE meta_table SET '
+                             'collision_count = collision_count + 1')
+                continue
+            # may fail on the hardlink limit or across file systems
+            if self.link(src, path):
+                self.insert(digest, path, inode)
+                self.count(0)
+                return None
+        self.insert(digest, path, PENDING)
+        # a new file, encode replaces path instead of writing through a
+        # hardlink of another tile
+        result = encode(im, path)
+        self.execute('UPDATE mapping_table SET inode = ? WHERE hash = ? AND '
+                     'path = ?', (file_inode(path), digest, path))
+        self.count(1)
+        return result
@@ -0,0 +1,51 @@
+from PIL import Image
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# downsampling methods of the upper pyramid levels
+# lanczos: paste the children on a 2x canvas and shrink it with LANCZOS
+# box:     shrink each child with Image.reduce(2) into its quadrant
+# numpy:   premultiplied 2x2 average of each child, require numpy
+METHODS = ['lanczos', 'box', 'numpy']
+
+
+def reduce_box(im):
+    # 2x2 box average, alpha premultiplied by PIL
+    if im.mode != 'RGBA':
+        im = im.convert('RGBA')
+    if hasattr(im, 'reduce'):
+        return im.reduce(2)
+    w, h = im.size
+    return im.resize(((w + 1) >> 1, (h + 1) >> 1), Image.BOX)  # pillow < 7
+
+
+def reduce_numpy(im):
+    # 2x2 average of alpha premultiplied pixels, odd edges are averaged
+    # over the pixels available like Image.reduce
+    a = numpy.asarray(im.convert('RGBa'), dtype=numpy.uint16)
+    h, w = a.shape[:2]
+    if h & 1 or w & 1:
+        a = numpy.pad(a, ((0, h & 1), (0, w & 1), (0, 0)), mode='edge')
+    s = a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+    s += 2
+    s >>= 2
+    out = s.astype(numpy.uint8)
+    size = out.shape[1], out.shape[0]
+    return Image.frombuffer('RGBa', size, out.tobytes(), 'raw', 'RGBa', 0, 1
+                            ).convert('RGBA')
+
+
+def get_reducer(method):
+    # per child reducer of a method, None for the 2x canvas with LANCZOS
+    if method == 'box':
+        return reduce_box
+    if method == 'numpy':
+        if numpy is None:
+            print('numpy not found, use box downsampling')
+            return reduce_box
+        return reduce_numpy
+    if method != 'lanczos':
+        print('Unknown downsample method {}, use lanczos'.format(method))
+    return None
@@ -87,15 +87,8 @@ def get_version_info(path, fast_mode=True):
     return version_info
 
 
-def read_zpop(data, pos, size):
-    zpop = []
-    for x in range(size):
-        line = []
-        for y in range(size):
-            pop, pos = util.read_uint8(data, pos)
-            line.append(pop)
-        zpop.append(line)
-    return zpop, pos
+def read_zpop(reader, size):
+    return [reader.uint8_list(size) for x in range(size)]
 
 
 def load_lotheader(path, x, y):
@@ -112,23 +105,22 @@ def load_lotheader(path, x, y):
     header['x'] = x
     header['y'] = y
 
-    version, pos = binfile.get_version(data, 0, b'LOTH', util.read_uint32)
+    reader = util.BinaryReader(data)
+    version = binfile.get_version(reader, b'LOTH', util.BinaryReader.uint32)
     header.update(VERSION_LIMITATIONS[version])
     header['version'] = version
 
-    header['tiles'], pos = binfile.read_tile_defs(data, pos)
+    header['tiles'] = binfile.read_tile_defs(reader)
 
     if version == 0:  # B41
-        pos += 1  # skip 0x00
-    header['width'], pos = util.read_uint32(data, pos)
-    header['height'], pos = util.read_uint32(data, pos)
+        reader.skip(1)  # skip 0x00
+    header['width'], header['height'] = reader.values('I', 2)
 
     if header['version'] == 0:  # B41
         minlayer = 0
-        maxlayer, pos = util.read_int32(data, pos)
+        maxlayer = reader.int32()
     else:
-        minlayer, pos = util.read_int32(data, pos)
-        maxlayer, pos = util.read_int32(data, pos)
+        minlayer, maxlayer = reader.values('i', 2)
         maxlayer += 1
 
     minlayer = max(minlayer, header['MIN_LAYER'])
@@ -136,9 +128,9 @@ def load_lotheader(path, x, y):
     header['minlayer'] = minlayer
     header['maxlayer'] = maxlayer
 
-    header['rooms'], pos = binfile.read_rooms(data, pos)
-    header['buildings'], pos = binfile.read_buildings(data, pos)
-    header['zpop'], pos = read_zpop(data, pos, header['CELL_SIZE_IN_BLOCKS'])
+    header['rooms'] = binfile.read_rooms(reader)
+    header['buildings'] = binfile.read_buildings(reader)
+    header['zpop'] = read_zpop(reader, header['CELL_SIZE_IN_BLOCKS'])
     return header
 
 
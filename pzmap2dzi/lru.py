@@ -50,6 +50,37 @@ class LRU(object):
             return None, None
 
 
+class BudgetLRU(object):
+    # least recently used cache limited by the total size of its values
+    def __init__(self, budget, size_func):
+        self.budget = budget
+        self.size_func = size_func
+        self.used = 0
+        self.lru = LRU()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # returns (found, value)
+        if key not in self.lru.m:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        key, (value, size) = self.lru.pop(key)
+        self.lru.save(key, (value, size))
+        return True, value
+
+    def put(self, key, value):
+        size = self.size_func(value)
+        if size > self.budget or key in self.lru.m:
+            return
+        self.lru.save(key, (value, size))
+        self.used += size
+        while self.used > self.budget:
+            _, (_, old_size) = self.lru.pop()
+            self.used -= old_size
+
+
 def test():
     c = SingleUseLRU(5)
     for i in range(10):
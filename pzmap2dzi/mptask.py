@@ -378,6 +378,12 @@ class _CoordinatorProcess:
         return None
 
 
+def workers_forked():
+    # workers share the memory of the coordinator (copy-on-write) only when
+    # forked, spawned workers receive a pickled copy of the worker instead
+    return multiprocessing.get_start_method() == 'fork'
+
+
 def split_list(a, n):
     if n < 1:
         n = 1
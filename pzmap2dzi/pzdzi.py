@@ -1,18 +1,18 @@
 from PIL import Image
+import io
 import os
 import sys
-import re
 import time
 import datetime
+from multiprocessing.pool import ThreadPool
 from . import mptask, util, scheduling, geometry, lotheader, source_manager
+from . import downsample, dedup, tile_state
 
 DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
 <Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" Format="{format}">
   <Size Width="{width}" Height="{height}"/>
 </Image>
 '''
-PENDING_PATTERN = re.compile('(\\d+)_(\\d+)\\.pending$')
-DONE_TEMPLATE = '(\\d+)_(\\d+)\\.(?:empty|{})$'
 
 
 RGB_FMT = set(['jpg', 'jpeg'])
@@ -70,13 +70,23 @@ def normalize_rects(rects):
     return normalized
 
 
+class LayerOccupancy(object):
+    # layer rects of a group of cells, see PZDZI.build_layer_index
+    def __init__(self, dzi):
+        self.dzi = dzi
+
+    def on_job(self, cells):
+        render = self.dzi.render
+        return [((cx, cy), render.layer_occupancy(self.dzi, cx, cy))
+                for cx, cy in cells]
+
+
 class DZI(object):
     def __init__(self, w, h, **options):
         self.w = w
         self.h = h
         self.path = options.get('output', './dzi')
         assert self.tile_size is not None
-        self.save_empty = options.get('save_empty_tile', False)
         self.ext = options.get('image_fmt', 'png').lower()
         self.ext0 = options.get('image_fmt_layer0', self.ext).lower()
         self.save_options = {}
@@ -86,8 +96,33 @@ class DZI(object):
         if save_options:
             self.save_options[self.ext] = save_options.get(self.ext, {})
             self.save_options[self.ext0] = save_options.get(self.ext0, {})
-        self.done_pattern = re.compile(DONE_TEMPLATE.format(self.ext0))
+        # pending, empty and done tiles, see tile_state
+        self.tile_states = tile_state.TileState(
+            os.path.join(self.path, tile_state.DB_NAME))
+        # check the tile files against the manifest before planning
+        self.verify_tiles = options.get('verify_tiles', False)
+        # occupied layers of tiles by level, see PZDZI.build_layer_index
+        self.layer_index = None
         self.skip_level = options.get('skip_level', 0)
+        # children are reduced into their quadrant of the parent tile, the
+        # quadrants need an even tile size
+        self.reducer = downsample.get_reducer(
+            options.get('downsample', 'lanczos'))
+        if self.tile_size & 1:
+            self.reducer = None
+        # threads of each worker encoding and writing tiles while the worker
+        # goes on, at most encoder_queue tiles wait for a thread
+        self.encoder_threads = options.get('encoder_threads', 0)
+        self.encoder_queue = options.get('encoder_queue', 8)
+        # hardlink identical tiles, the mapping is shared by all the renders
+        # of the output root
+        self.dedup = None
+        if options.get('dedup_with_hardlink', False):
+            root = options.get('output_root', self.path)
+            util.ensure_folder(root)
+            self.dedup = dedup.Dedup(os.path.join(root, dedup.DB_NAME),
+                                     options.get('dedup_hash_function'),
+                                     self.save_options)
         self.cache_enabled = False
         self.cache_limit = 0
         if sys.version_info >= (3, 8):
@@ -117,12 +152,15 @@ class DZI(object):
         h = max(0, self.tile_size - max(0, y - h))
         return im.crop((0, 0, w, h))
 
-    def mark_empty(self, level, tx, ty, layer):
-        ext, path = self.tile_path(level, tx, ty, layer, 'empty')
-        with open(path, 'w') as f:
-            pass
+    def mark_empty(self, tiles):
+        # tiles: (level, tx, ty) completed without content
+        now = time.time()
+        self.tile_states.set_many([(level, tx, ty, tile_state.EMPTY, now, ())
+                                   for level, tx, ty in tiles])
 
-    def save_tile(self, im, level, tx, ty, layer, force=False):
+    def save_tile(self, im, level, tx, ty, layer, force=False, writer=None):
+        # writer: scheduling.TileWriter to encode and write the tile on its
+        #         threads, the returned state does not depend on the write
         write_all = force or not self.cache_enabled
         if not write_all and level >= self.levels - self.skip_level:
             return 'skip'
@@ -131,35 +169,75 @@ class DZI(object):
         if im and im.getbbox():
             ext, path = self.tile_path(level, tx, ty, layer)
         else:
-            if self.save_empty and layer == 0:
-                # only layer 0 is used as sentinel
-                self.mark_empty(level, tx, ty, layer)
-            self.delete_tile(level, tx, ty, layer)
+            self.delete_tile(level, tx, ty, layer, tile=(level, tx, ty))
             return 'empty'
 
-        if not supports_RGBA(ext):
-            im = im.convert('RGB')
+        if writer:
+            writer.put((level, tx, ty), self.write_tile,
+                       im, ext, path, level, tx, ty, layer, write_all)
+        else:
+            self.write_tile(im, ext, path, level, tx, ty, layer, write_all)
+
+        return 'saved'
 
-        im.save(path, **self.save_options[ext])
+    def write_tile(self, im, ext, path, level, tx, ty, layer, write_all):
+        # the file is recorded with the state of the tile (see clear_wip),
+        # a file linked by dedup is read back for its digest
+        if self.dedup:
+            digest = self.dedup.save(im, ext, path, self.encode_tile)
+        else:
+            digest = self.encode_tile(im, path)
+        self.tile_states.add_file((level, tx, ty), (level, layer, tx, ty, ext),
+                                  path, digest)
 
         if (write_all and level != self.levels and
                 level + 1 >= self.levels - self.skip_level):
             self.delete_skip_tiles(level, tx, ty, layer)
 
-        return 'saved'
+    def encode_tile(self, im, path):
+        # written to a temporary file then renamed, so a tile hardlinked by
+        # dedup (in this or an earlier run) is replaced, never written through
+        # returns the digest of the encoded data for the manifest
+        ext = os.path.splitext(path)[1][1:]
+        if not supports_RGBA(ext):
+            im = im.convert('RGB')
+        data = io.BytesIO()
+        im.save(data, Image.registered_extensions()['.' + ext],
+                **self.save_options[ext])
+        data = data.getvalue()
+        tmp = dedup.temp_path(path)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            dedup.replace_file(tmp, path)
+            return tile_state.digest(data)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
 
     def delete_skip_tiles(self, level, tx, ty, layer):
         for i in [0, 1]:
             for j in [0, 1]:
-                self.delete_tile(level + 1, i + tx*2, j + ty*2, layer)
+                self.delete_tile(level + 1, i + tx*2, j + ty*2, layer,
+                                 tile=(level, tx, ty))
 
-    def delete_tile(self, level, tx, ty, layer, ext=None):
+    def delete_tile(self, level, tx, ty, layer, ext=None, tile=None):
+        # tile: (level, x, y) of the tile being rendered, the removal is
+        #       recorded with its state instead of right away
         ext, path = self.tile_path(level, tx, ty, layer, ext)
         if os.path.isfile(path):
             try:
                 os.remove(path)
             except Exception as e:
                 pass
+            if ext in tile_state.TILE_EXTS:
+                key = level, layer, tx, ty, ext
+                if tile:
+                    self.tile_states.remove_file(tile, key)
+                else:
+                    self.tile_states.forget_files([key])
+            if self.dedup and ext in self.save_options:
+                self.dedup.forget(path)
 
     def get_ext(self, layer):
         return self.ext0 if layer == 0 else self.ext
@@ -181,13 +259,17 @@ class DZI(object):
         return im
 
     def set_wip(self, level, x, y):
-        ext, path = self.tile_path(level, x, y, 0, 'pending')
-        with open(path, 'w') as f:
-            pass
-
-    def clear_wip(self, level, x, y):
-        ext, path = self.tile_path(level, x, y, 0, 'pending')
-        os.remove(path)
+        self.tile_states.set(level, x, y, tile_state.PENDING)
+
+    def clear_wip(self, level, x, y, layers):
+        # layers: layers written with content, None when the tile is kept
+        #         unwritten in the cache (see TopologicalDziWorker.on_msg)
+        if layers is None:
+            self.tile_states.forget([(level, x, y)])
+        elif layers:
+            self.tile_states.set(level, x, y, tile_state.DONE, layers)
+        else:
+            self.tile_states.set(level, x, y, tile_state.EMPTY)
 
     def create_empty_output(self):
         for layer in range(self.render_minlayer, self.render_maxlayer):
@@ -244,29 +326,17 @@ class DZI(object):
             for tag in tags:
                 self.delete_tile(level, tx, ty, layer, tag)
 
-    def clear_pending_tiles(self, existing_tiles, pending, verbose):
-        if not pending:
-            return
-        pending = pending[0] # pending only has layer 0
+    def clear_pending_tiles(self, pending, verbose):
+        # tiles left pending by an interrupted render, the layers written
+        # before the interruption are not recorded
         if not pending:
             return
-        pending_coords = [None] * len(pending)
-        pending_count = 0
-        for level, coord_map in enumerate(pending):
-            if not coord_map:
-                continue
-            pending_coords[level] = set(coord_map.keys())
-            pending_count += len(coord_map)
-        if pending_count == 0:
-            return
         if verbose:
-            print('Cleaning {} stale pending coordinates'.format(pending_count))
-        for level, coords in enumerate(pending_coords):
-            if not coords:
-                continue
-            for tx, ty in coords:
-                self.delete_tile_all_layers(existing_tiles, level, tx, ty)
-                self.delete_tile(level, tx, ty, 0, 'pending')
+            print('Cleaning {} stale pending coordinates'.format(len(pending)))
+        for level, tx, ty in pending:
+            for layer in range(self.minlayer, self.maxlayer):
+                self.delete_tile(level, tx, ty, layer)
+        self.tile_states.forget(pending)
 
     def normalize_layered_tile_map(self, tile_map):
         if not tile_map:
@@ -279,14 +349,163 @@ class DZI(object):
             layers[max_layer:max_layer] = missing_layers
         return layers
 
-    def get_existing_tiles(self, clear_pending, verbose):
+    def import_tile_markers(self, verbose):
+        # outputs of earlier versions mark tiles with .pending and .empty
+        # files, their states are moved into the state store once
         if verbose:
             print('Scanning existing tiles.')
         existing = source_manager.collect(self.path, ['tiles', 'pending'], source_manager.SIGNATURE_MTIME, None, verbose)
-        pending = self.normalize_layered_tile_map(existing['pending'])
-        existing_tiles = self.normalize_layered_tile_map(existing['tiles'])
+        tiles = {}
+        markers = []
+        for name in ['tiles', 'pending']:
+            layers = self.normalize_layered_tile_map(existing[name])
+            for layer in range(self.minlayer, self.maxlayer):
+                if not layers[layer]:
+                    continue
+                ext = self.get_ext(layer)
+                for level, coord_map in enumerate(layers[layer]):
+                    for (tx, ty), (mtime, tags) in coord_map.items():
+                        key = level, tx, ty
+                        if 'pending' in tags:
+                            tiles[key] = [tile_state.PENDING, mtime, []]
+                            markers.append(key + (layer, 'pending'))
+                            continue
+                        if 'empty' in tags:
+                            markers.append(key + (layer, 'empty'))
+                        elif ext not in tags:
+                            continue
+                        state = tiles.setdefault(key, [tile_state.EMPTY, mtime, []])
+                        state[1] = min(state[1], mtime)
+                        if ext in tags:
+                            state[0] = tile_state.DONE
+                            state[2].append(layer)
+        self.tile_states.set_many([key + tuple(state)
+                                   for key, state in tiles.items()])
+        for level, tx, ty, layer, ext in markers:
+            self.delete_tile(level, tx, ty, layer, ext)
+
+    def verify_manifest(self, verbose, hash_files=True):
+        # reconcile the manifest with the tile files, the level folders are
+        # scanned and the files changed, untracked or without a hash are
+        # hashed in parallel
+        # tiles with files missing or modified are rendered again
+        # hash_files: False to record the files found without a hash (filled
+        #             in when the tile is written again, or by a verify)
+        if verbose:
+            print('Verifying tile files.' if hash_files else 'Scanning tile files.')
+        folders = []
+        for layer in range(self.minlayer, self.maxlayer):
+            layer_path = os.path.join(self.path, 'layer{}_files'.format(layer))
+            for level in range(self.levels):
+                folders.append((level, layer, os.path.join(layer_path, str(level))))
+        pool = ThreadPool()
+        files = {}
+        for found in pool.imap_unordered(tile_state.scan_folder, folders):
+            files.update(found)
+        recorded = {}
+        for row in self.tile_states.load_files():
+            level, layer = row[:2]
+            if level < self.levels and self.minlayer <= layer < self.maxlayer:
+                recorded[row[:5]] = row[5:]
+        missing = [key for key in recorded if key not in files]
+        changed = [key for key, value in files.items()
+                   if key not in recorded or recorded[key][:2] != value or
+                   (hash_files and recorded[key][2] is None)]
+        digests = [None] * len(changed)
+        if hash_files:
+            paths = [self.tile_path(level, tx, ty, layer, ext)[1]
+                     for level, layer, tx, ty, ext in changed]
+            digests = self.hash_tile_files(pool, paths, verbose)
+        pool.close()
+        pool.join()
+        rows = []
+        invalid = set((level, tx, ty) for level, layer, tx, ty, ext in missing)
+        modified = 0
+        untracked = 0
+        for key, digest in zip(changed, digests):
+            rows.append(key + files[key] + (digest,))
+            if key not in recorded:
+                untracked += 1
+            elif digest is not None and recorded[key][2] not in (None, digest):
+                invalid.add((key[0], key[2], key[3]))
+                modified += 1
+        for level, tx, ty, state, mtime, layers in self.tile_states.load():
+            if state != tile_state.DONE:
+                continue
+            for layer in layers:
+                key = level, layer, tx, ty, self.get_ext(layer)
+                if self.minlayer <= layer < self.maxlayer and key not in files:
+                    invalid.add((level, tx, ty))
+        self.tile_states.forget_files(missing)
+        self.tile_states.set_files(rows)
+        self.tile_states.forget(list(invalid))
+        self.tile_states.set_current()
+        if verbose:
+            print('Tile files: {} missing, {} modified, {} untracked, {} tiles to render again'.format(
+                  len(missing), modified, untracked, len(invalid)))
+
+    def hash_tile_files(self, pool, paths, verbose):
+        # digests of paths, with the progress and the time left
+        if not paths:
+            return []
+        digests = []
+        total = len(paths)
+        start = time.time()
+        template = 'Hashing tile files: {progress} / {total}, {left} left'
+        progress_display = util.ProgressDisplay(template if verbose else '')
+        for progress, digest in enumerate(pool.imap(tile_state.file_digest, paths, 64), start=1):
+            digests.append(digest)
+            if progress % 256 == 0:
+                left = (time.time() - start) * (total - progress) / progress
+                progress_display.update(progress=progress, total=total,
+                                        left=datetime.timedelta(0, int(left)))
+        progress_display.finish(progress=total, total=total,
+                                left=datetime.timedelta(0))
+        return digests
+
+    def add_existing_tile(self, existing_tiles, layer, level, tx, ty, mtime, tag):
+        if level >= self.levels or not self.minlayer <= layer < self.maxlayer:
+            return
+        if existing_tiles[layer] is None:
+            existing_tiles[layer] = [{} for _ in range(self.levels)]
+        coord_map = existing_tiles[layer][level]
+        if (tx, ty) in coord_map:
+            last_mtime, tags = coord_map[(tx, ty)]
+            tags.add(tag)
+            coord_map[(tx, ty)] = max(mtime, last_mtime), tags
+        else:
+            coord_map[(tx, ty)] = mtime, set([tag])
+
+    def get_existing_tiles(self, clear_pending, verbose):
+        if not self.tile_states.exists():
+            self.import_tile_markers(verbose)
+        if self.verify_tiles:
+            self.verify_manifest(verbose)
+        elif self.tile_states.outdated():
+            # hashing all the tiles of an existing output takes hours on a
+            # full map, they are hashed when written again or by a verify
+            self.verify_manifest(verbose, False)
+            print('Tile manifest created without hashes, use --verify to hash the existing tiles')
+        existing_tiles = [None] * (self.maxlayer - self.minlayer)
+        pending = []
+        completed = {}
+        for level, tx, ty, state, mtime, layers in self.tile_states.load():
+            if state == tile_state.PENDING:
+                pending.append((level, tx, ty))
+                continue
+            completed[(level, tx, ty)] = mtime
+            if 0 not in layers:
+                # layer 0 is used as sentinel of completed tiles
+                self.add_existing_tile(existing_tiles, 0, level, tx, ty, mtime, 'empty')
+        # the files of completed tiles from the manifest, the last render
+        # time is the time of the state, a file hardlinked by dedup keeps
+        # the mtime of the first file written
+        for level, layer, tx, ty, ext, mtime, size, digest in self.tile_states.load_files():
+            key = level, tx, ty
+            if key in completed:
+                self.add_existing_tile(existing_tiles, layer, level, tx, ty, completed[key], ext)
         if clear_pending:
-            self.clear_pending_tiles(existing_tiles, pending, verbose)
+            self.clear_pending_tiles(pending, verbose)
         return existing_tiles
 
     def get_completed_signatures(self, existing_tiles):
@@ -347,6 +566,7 @@ class DZI(object):
             progress_display.update(progress=progress, total=total)
             self.delete_tile_all_layers(existing_tiles, level, tx, ty)
         progress_display.finish(progress=total, total=total)
+        self.tile_states.forget(list(stale_coords))
 
     def add_thumbnail_tasks(self, tasks_by_level, completed_by_level, verbose):
         # tasks_by_level only have bottom level populated, add thumbnail tasks for upper levels if needed
@@ -384,6 +604,8 @@ class DZI(object):
                         stack.append((level + 1, cx, cy))
 
     def merge_tile(self, im_getter, level, tx, ty, layer, cached=None):
+        if self.reducer:
+            return self.reduce_tile(im_getter, level, tx, ty, layer, cached)
         tile = None
         for i in [0, 1]:
             for j in [0, 1]:
@@ -404,6 +626,48 @@ class DZI(object):
             tile.thumbnail((self.tile_size, self.tile_size), Image.LANCZOS)
             im_getter.get().paste(tile, (0, 0))
 
+    def reduce_tile(self, im_getter, level, tx, ty, layer, cached=None):
+        half = self.tile_size >> 1
+        for i in [0, 1]:
+            for j in [0, 1]:
+                idx = j + i*2
+                if cached and cached[idx] is not None:
+                    im = cached[idx]
+                else:
+                    im = self.load_tile(level + 1, i + tx*2, j + ty*2, layer)
+                if im == 'empty':
+                    im = None
+                if im:
+                    im = self.reducer(im)
+                    im_getter.get().paste(im, (half * i, half * j))
+                    im = None
+
+    def get_layer_map(self, level, tx, ty):
+        # layer map of the layers with content of a tile, None if unknown
+        if not self.layer_index:
+            return None
+        layers = self.layer_index[level].get((tx, ty))
+        if layers is None:
+            return None
+        layer_map = [0] * self.layers
+        for layer in layers:
+            layer_map[layer] = 1
+        return layer_map
+
+    def render_layers(self, layer_map):
+        # layers to render for a tile with given occupied layer map
+        # layers drawn over the layers below (non RGBA formats) are kept
+        # when any layer below has content
+        if layer_map is None:
+            return list(range(self.render_minlayer, self.render_maxlayer))
+        layers = []
+        for layer in range(self.render_minlayer, self.render_maxlayer):
+            if layer_map[layer]:
+                layers.append(layer)
+            elif layers and not supports_RGBA(self.get_ext(layer)):
+                layers.append(layer)
+        return layers
+
     def render_below(self, im_getter, layer, layer_cache):
         ext = self.get_ext(layer)
         if supports_RGBA(ext):
@@ -414,6 +678,12 @@ class DZI(object):
                 im = im_getter.get()
                 im.alpha_composite(im_below)
 
+    def render_tile_layers(self, im_getters, tx, ty, layer_cache):
+        # im_getters: {layer: im_getter} of the layers to render
+        for layer in sorted(im_getters):
+            self.render_tile(im_getters[layer], tx, ty, layer, layer_cache)
+            layer_cache[layer] = im_getters[layer].im
+
     def render_all(self, render, n, break_key=None, verbose=False, profile=0):
         if verbose:
             print('Preparing data')
@@ -440,7 +710,14 @@ class DZI(object):
             return True
         self.create_empty_output()
         self.render = render
-        tasks_by_level, completed_by_level = self.get_tasks(verbose)
+        tasks_by_level, completed_by_level = self.get_tasks(verbose, n)
+        # no connection must be carried over to the workers of preload
+        # (see coverage.tile_counts) and of the render
+        self.tile_states.close()
+        if self.dedup:
+            self.dedup.close()
+        if hasattr(render, 'preload'):
+            render.preload(self, verbose, n)
         schd = scheduling.TopologicalDziScheduler(self, break_key, verbose)
         cache_prefix = 'pzdzi.{}.'.format(os.getpid())
         worker = scheduling.TopologicalDziWorker(self, cache_prefix)
@@ -477,6 +754,7 @@ class PZDZI(DZI):
         self.minlayer = version_info['minlayer']
         self.maxlayer = version_info['maxlayer']
         self.hash_method = options.get('hash_method')
+        self.use_layer_index = options.get('occupied_layer_index', True)
         self.pzmap2dzi_version = options.get('pzmap2dzi_version', 'unknown')
         self.git_branch = options.get('git_branch', '')
         self.git_commit = options.get('git_commit', '')
@@ -658,7 +936,7 @@ class PZDZI(DZI):
                         snapshot[coord] = (now, new_sig_hash)
         return snapshot
 
-    def get_tasks(self, verbose):
+    def get_tasks(self, verbose, parallel=1):
         # return tasks_by_level: List[Dict[Tuple[int, int], int]], completed_by_level: List[Set[Tuple[int, int]]]
         # tasks_by_level[layer][(tx, ty)] = dependency count for the task
         #     indicate number of lower level tiles that need to be completed before this tile can be rendered
@@ -683,8 +961,102 @@ class PZDZI(DZI):
             self.remove_stale_tiles(existing_tiles, stale_coords, verbose)
         self.add_thumbnail_tasks(tasks_by_level, completed_by_level, verbose)
         self.remove_skipped_tasks(tasks_by_level, completed_by_level, verbose)
+        self.build_layer_index(tasks_by_level, completed_by_level, verbose, parallel)
+        self.complete_empty_tasks(tasks_by_level, completed_by_level, existing_tiles, verbose)
         return tasks_by_level, completed_by_level
 
+    def build_layer_index(self, tasks_by_level, completed_by_level, verbose, parallel=1):
+        # layer_index[level][(tx, ty)] = tuple of layers with content
+        # bottom level: from the layer rects of each cell (render.layer_occupancy)
+        #     only tiles to render are indexed, all cells affecting them are
+        #     decoded in parallel by groups of cells (LayerOccupancy)
+        # upper levels: union of the 4 lower tiles, only indexed when all of them
+        #     are known (indexed, or neither rendered nor completed)
+        self.layer_index = None
+        if not self.use_layer_index:
+            return
+        if not hasattr(self.render, 'layer_occupancy'):
+            return
+        bottom = self.levels - 1
+        tasks = tasks_by_level[bottom]
+        if not tasks:
+            return
+        occupied = dict((coord, set()) for coord in tasks)
+        cells = []
+        for cx, cy in sorted(self.cells):
+            sx = cx * self.cell_size
+            sy = cy * self.cell_size
+            affected = self.square_rect2tiles(sx, sy, self.cell_size, self.cell_size)
+            if any(coord in occupied for coord in affected):
+                cells.append((cx, cy))
+        if verbose:
+            print('Indexing layers of {} cells'.format(len(cells)))
+        worker = LayerOccupancy(self)
+        if parallel > 1 and len(cells) > parallel:
+            # no connection must be carried over to the workers
+            self.tile_states.close()
+            if self.dedup:
+                self.dedup.close()
+            jobs = mptask.split_list(cells, parallel * 4)
+            results = mptask.Task(worker, verbose).run(jobs, parallel)
+        else:
+            results = [worker.on_job(cells)]
+        if any(result is None for result in results):
+            # tiles of a missing cell would be taken as empty, render all
+            print('Layer index failed, rendering all layers')
+            return
+        for result in results:
+            for cell_coord, rects in result:
+                for layer, layer_rects in rects.items():
+                    if layer < self.render_minlayer or layer >= self.render_maxlayer:
+                        continue
+                    for rx, ry, rw, rh in layer_rects:
+                        for coord in self.layer_rect2tiles(rx, ry, rw, rh, layer):
+                            if coord in occupied:
+                                occupied[coord].add(layer)
+        layer_index = [{} for _ in range(self.levels)]
+        for coord, layers in occupied.items():
+            layer_index[bottom][coord] = tuple(sorted(layers))
+        for level in reversed(range(bottom)):
+            lower_index = layer_index[level + 1]
+            lower_tasks = tasks_by_level[level + 1]
+            lower_done = completed_by_level[level + 1]
+            for x, y in tasks_by_level[level]:
+                layers = set()
+                for coord in lower_level_depend(x, y):
+                    if coord in lower_index:
+                        layers.update(lower_index[coord])
+                    elif coord in lower_tasks or coord in lower_done:
+                        break
+                else:
+                    layer_index[level][(x, y)] = tuple(sorted(layers))
+        self.layer_index = layer_index
+
+    def complete_empty_tasks(self, tasks_by_level, completed_by_level, existing_tiles, verbose):
+        # tiles without content on any layer (see build_layer_index) are
+        # completed here instead of being dispatched to workers
+        # bottom level first, so thumbnails with only empty lower tiles are
+        # completed as well
+        if not self.layer_index:
+            return
+        completed = []
+        for level in reversed(range(self.levels)):
+            index = self.layer_index[level]
+            tasks = tasks_by_level[level]
+            empty = [coord for coord in tasks if index.get(coord) == ()]
+            for tx, ty in empty:
+                del tasks[(tx, ty)]
+                completed_by_level[level].add((tx, ty))
+                self.delete_tile_all_layers(existing_tiles, level, tx, ty)
+                if level > 0:
+                    parent = tx >> 1, ty >> 1
+                    if tasks_by_level[level - 1].get(parent, 0) > 0:
+                        tasks_by_level[level - 1][parent] -= 1
+            completed.extend((level, tx, ty) for tx, ty in empty)
+        self.mark_empty(completed)
+        if verbose:
+            print('Empty tiles: {}'.format(len(completed)))
+
     def post_process(self, failed_sources, interrupted):
         self.finalize_snapshot(failed_sources, interrupted)
 
@@ -949,6 +1321,13 @@ class IsoDZI(PZDZI):
 
         return tiles
 
+    def layer_rect2tiles(self, sx, sy, w, h, layer):
+        # tiles of a layer affected by a square rect on the layer
+        left, top, right, bottom = self.affected_margin_single_layers
+        shift = IsoDZI.GRID_HEIGHT_PER_LAYER * layer
+        margin = left, top - shift, right, bottom - shift
+        return self.square_rect2tiles(sx, sy, w, h, margin)
+
     def render_tile(self, im_getter, tx, ty, layer, layer_cache):
         self.render_below(im_getter, layer, layer_cache)
         gx0, gy0 = self.tile2grid(tx, ty, layer)
@@ -971,6 +1350,28 @@ class IsoDZI(PZDZI):
                 ox, oy = self.get_sqr_center(gx - gx0, gy - gy0)
                 self.render.square(im_getter, self, ox, oy, sx, sy, layer)
 
+    def render_tile_layers(self, im_getters, tx, ty, layer_cache):
+        if not hasattr(self.render, 'tile_layers'):
+            return DZI.render_tile_layers(self, im_getters, tx, ty, layer_cache)
+        # render all layers in a single pass over the squares of the tile
+        # except layers drawn over the layers below (non RGBA formats),
+        # which are rendered afterwards once the layers below are complete
+        single_pass = {}
+        below = []
+        for layer in sorted(im_getters):
+            if supports_RGBA(self.get_ext(layer)):
+                single_pass[layer] = im_getters[layer]
+            else:
+                below.append(layer)
+        if single_pass:
+            gx0, gy0 = self.tile2grid(tx, ty, 0)
+            self.render.tile_layers(single_pass, self, gx0, gy0)
+        for layer in single_pass:
+            layer_cache[layer] = im_getters[layer].im
+        for layer in below:
+            self.render_tile(im_getters[layer], tx, ty, layer, layer_cache)
+            layer_cache[layer] = im_getters[layer].im
+
     def update_map_info(self, info):
         info = self.update_pz_map_info(info)
         info['x0'] = -self.gxo * IsoDZI.GRID_WIDTH
@@ -1019,6 +1420,9 @@ class TopDZI(PZDZI):
                 tiles.append((cx - self.cxo, cy - self.cyo))
         return tiles
 
+    def layer_rect2tiles(self, sx, sy, w, h, layer):
+        return self.square_rect2tiles(sx, sy, w, h)
+
     def render_tile(self, im_getter, tx, ty, layer, layer_cache):
         self.render_below(im_getter, layer, layer_cache)
         cx, cy = self.tile2cell(tx, ty)
@@ -1,5 +1,8 @@
-from .. import cell, texture
+from PIL import Image
+from .. import cell, cell_cache, coverage, lru, texture
+import os
 import re
+import sys
 
 try:
     from functools import lru_cache
@@ -8,8 +11,51 @@ except ImportError:
 
 
 @lru_cache(maxsize=16)
-def load_cell_cached(path, cx, cy):
-    return cell.load_cell(path, cx, cy)
+def load_cell_cached(path, cx, cy, lazy=False, layer_range=None, cache=None):
+    return cell.load_cell(path, cx, cy, lazy, layer_range, cache)
+
+
+def get_cell_cache(options):
+    # decoded cells are shared by all render commands of a map
+    if not options.get('cell_cache') or sys.version_info < (3, 0):
+        return None
+    output_root = options.get('output_root')
+    if not output_root:
+        return None
+    path = os.path.join(output_root, 'cache', 'cells',
+                        options.get('cache_name', 'default'))
+    return cell_cache.CellCache(path, options.get('hash_method'))
+
+
+def sprite_size(sprite):
+    if sprite is None:
+        return 64
+    w, h = sprite.im.size
+    return 4 * w * h + 64
+
+
+def composite(parts):
+    # parts: [(texture, x), ...] drawn in order at (x, 0)
+    # returns a single Texture with the same offset rule, None if empty
+    parts = [(tex, x) for tex, x in parts if tex.im.size[0] and tex.im.size[1]]
+    if not parts:
+        return None
+    left = min(tex.ox + x for tex, x in parts)
+    top = min(tex.oy for tex, x in parts)
+    right = max(tex.ox + x + tex.im.size[0] for tex, x in parts)
+    bottom = max(tex.oy + tex.im.size[1] for tex, x in parts)
+    im = Image.new('RGBA', (right - left, bottom - top))
+    for tex, x in parts:
+        tex.render(im, x - left, -top)
+    return texture.Texture(im, (left, top))
+
+
+def cell_occupied_rects(path, cx, cy, layer_range, cache=None):
+    # {layer: square rects} of a cell, used to plan which layers to render
+    c = cell.load_cell(path, cx, cy, True, layer_range, cache)
+    if not c:
+        return {}
+    return c.occupied_rects()
 
 
 class TextureRender(object):
@@ -23,34 +69,238 @@ class TextureRender(object):
         self.tl = texture.TextureLibrary(texture_path, cache_name)
         self.tl.config_plants(plants_conf)
 
+    def map_tile_names(self, dzi, parallel=1, verbose=False):
+        # tiles listed in the lotheaders of the map that have a texture,
+        # the missing ones are reported once here and marked missing in
+        # the texture library, so the render loop does not look for them
+        counts = coverage.tile_counts(self.input, dzi.cells, parallel, verbose)
+        missing = coverage.missing_tiles(self.tl, counts)
+        self.tl.set_missing(missing)
+        if missing:
+            report = os.path.join(dzi.path, coverage.REPORT_NAME)
+            coverage.save_report(report, missing, counts)
+            print('Missing textures: {}, see {}'.format(len(missing), report))
+        return set(counts).difference(missing)
+
+    def preload(self, dzi, verbose=False, parallel=1):
+        # textures of all tiles of the map,
+        # plant textures are blended or mapped on first use
+        if not getattr(self, 'input', None):
+            return
+        self.tl.preload(self.map_tile_names(dzi, parallel, verbose), verbose)
+
 
 class BaseRender(TextureRender):
     def __init__(self, **options):
         self.input = options.get('input')
         plants_conf = options.get('plants_conf', {})
         self.use_jumbo_tree = plants_conf.get('jumbo_tree_size', 3) > 3
+        self.lazy_cell = options.get('lazy_cell_loading', True)
+        self.cell_cache = get_cell_cache(options)
+        # composites of the squares of a block on one grid row, shared by
+        # all tiles the row overlaps, 0 to disable
+        sprite_cache_mb = options.get('block_sprite_cache_mb', 0)
+        self.block_sprites = None
+        if sprite_cache_mb:
+            self.block_sprites = lru.BudgetLRU(
+                sprite_cache_mb * 1024 * 1024, sprite_size)
+        # pre-blended tile stacks of a square keyed by cell and tile ids,
+        # 0 to disable
+        stack_cache_mb = options.get('stack_cache_mb', 0)
+        self.stacks = None
+        if stack_cache_mb:
+            self.stacks = lru.BudgetLRU(
+                stack_cache_mb * 1024 * 1024, sprite_size)
         TextureRender.__init__(self, **options)
 
     def update_options(self, options):
         options['render_margin'] = 'large' if self.use_jumbo_tree else 'normal'
         return options
 
+    def layer_occupancy(self, dzi, cx, cy):
+        layer_range = dzi.render_minlayer, dzi.render_maxlayer
+        return cell_occupied_rects(self.input, cx, cy, layer_range,
+                                   self.cell_cache)
+
+    def cell_textures(self, c):
+        # tile id -> Texture table, resolved once per cell
+        textures = c.remaps.get('texture')
+        if textures is None:
+            names = c.header['tiles']
+            textures = [self.tl.get_by_name(name) for name in names]
+            c.remaps['texture'] = textures
+        return textures
+
+    def block_row_sprite(self, c, index, layer, row, sqr_width):
+        # squares (x, row - x) of a block on a layer composited in draw
+        # order, as a Texture drawn from the bottom center of the first
+        # square x = max(0, row - block_size + 1), None if there is no tile
+        key = c.x, c.y, index, layer, row
+        found, sprite = self.block_sprites.get(key)
+        if found:
+            return sprite
+        textures = self.cell_textures(c)
+        offsets, tiles = c.get_block(index)
+        block_size = c.block_size
+        i = c.layer_offset(layer)
+        parts = []
+        for k, x in enumerate(range(max(0, row - block_size + 1),
+                                    min(row, block_size - 1) + 1)):
+            square = i + x * block_size + row - x
+            for t in tiles[offsets[square]: offsets[square + 1]]:
+                tex = textures[t]
+                if tex:
+                    parts.append((tex, k * sqr_width))
+        sprite = composite(parts)
+        self.block_sprites.put(key, sprite)
+        return sprite
+
+    def stack_texture(self, c, tiles):
+        # single Texture of the tiles of a square, None if nothing to draw
+        # tile ids are indices of the tile names of the cell
+        key = c.x, c.y, tuple(tiles)
+        found, tex = self.stacks.get(key)
+        if found:
+            return tex
+        textures = self.cell_textures(c)
+        tex = composite([(textures[t], 0) for t in tiles if textures[t]])
+        self.stacks.put(key, tex)
+        return tex
+
+    def get_stats(self):
+        # {cache name: (hits, misses)}, printed in the render summary
+        stats = {}
+        if self.block_sprites is not None:
+            stats['block sprite'] = (self.block_sprites.hits,
+                                     self.block_sprites.misses)
+        if self.stacks is not None:
+            stats['tile stack'] = self.stacks.hits, self.stacks.misses
+        return stats
+
     def square(self, im_getter, dzi, ox, oy, sx, sy, layer):
         oy += dzi.sqr_height >> 1  # center -> bottom center
         cx, subx = divmod(sx, dzi.cell_size)
         cy, suby = divmod(sy, dzi.cell_size)
-        c = load_cell_cached(self.input, cx, cy)
+        layer_range = dzi.render_minlayer, dzi.render_maxlayer
+        c = load_cell_cached(self.input, cx, cy, self.lazy_cell, layer_range,
+                             self.cell_cache)
         if not c:
             return
-        tiles = c.get_square(subx, suby, layer)
-        if not tiles:
+        tiles = c.get_square_ids(subx, suby, layer)
+        if tiles is None:
             return
+        if self.stacks is not None and len(tiles) > 1:
+            tex = self.stack_texture(c, tiles)
+            if tex:
+                tex.render(im_getter.get(), ox, oy)
+            return
+        textures = self.cell_textures(c)
         for t in tiles:
-            tex = self.tl.get_by_name(t)
+            tex = textures[t]
             if tex:
                 tex.render(im_getter.get(), ox, oy)
-            else:
-                print('missing tile: {}'.format(t))
+
+    def tile(self, im_getter, dzi, gx0, gy0, layer):
+        gy0 -= dzi.GRID_HEIGHT_PER_LAYER * layer
+        self.tile_layers({layer: im_getter}, dzi, gx0, gy0)
+
+    def tile_layers(self, im_getters, dzi, gx0, gy0):
+        # im_getters: {layer: im_getter}, (gx0, gy0): tile origin of layer 0
+        # same draw order per layer as IsoDZI.render_tile (grid rows top to
+        # bottom), each grid row is walked once for all layers in runs of
+        # squares sharing a cell and a block, along a run the square index
+        # in a block steps by block_size - 1 and the screen x by one square
+        gbox = gx0, gy0, gx0 + dzi.grid_per_tilex, gy0 + dzi.grid_per_tiley
+        if dzi.render_margin:
+            gbox = map(sum, zip(gbox, dzi.render_margin))
+        left, top, right, bottom = gbox
+        layer_range = dzi.render_minlayer, dzi.render_maxlayer
+        layer_shift = dzi.GRID_HEIGHT_PER_LAYER
+        layers = sorted(im_getters)
+        stacks = self.stacks
+        cell_size = dzi.cell_size
+        sqr_width = dzi.sqr_width
+        grid_width = dzi.sqr_width >> 1
+        grid_height = dzi.sqr_height >> 1
+        gy_min = top + layer_shift * layers[0]
+        gy_max = bottom + layer_shift * layers[-1]
+        for gy in range(gy_min, gy_max + 1):
+            active = []
+            for layer in layers:
+                layer_gy = gy - layer_shift * layer
+                if top <= layer_gy <= bottom:
+                    # center -> bottom center
+                    oy = (layer_gy - gy0 + 1) * grid_height
+                    active.append((layer, im_getters[layer], oy))
+            if not active:
+                continue
+            gx = left + ((left + gy) & 1)
+            count = ((right - gx) >> 1) + 1
+            sx = (gx + gy) >> 1
+            sy = (gy - gx) >> 1
+            ox = (gx - gx0) * grid_width
+            while count > 0:
+                cx, x = divmod(sx, cell_size)
+                cy, y = divmod(sy, cell_size)
+                run = min(count, cell_size - x, y + 1)
+                sx += run
+                sy -= run
+                count -= run
+                c = load_cell_cached(self.input, cx, cy, self.lazy_cell,
+                                     layer_range, self.cell_cache)
+                runs = []
+                if c:
+                    for layer, im_getter, oy in active:
+                        base = c.layer_offset(layer)
+                        if base is not None:
+                            runs.append((layer, base, im_getter, oy))
+                if not runs:
+                    ox += run * sqr_width
+                    continue
+                textures = self.cell_textures(c)
+                block_size = c.block_size
+                step = block_size - 1
+                while run > 0:
+                    bx, bsx = divmod(x, block_size)
+                    by, bsy = divmod(y, block_size)
+                    block_run = min(run, block_size - bsx, bsy + 1)
+                    x += block_run
+                    y -= block_run
+                    run -= block_run
+                    index = bx * c.block_per_cell + by
+                    offsets, tiles = c.get_block(index)
+                    first = bsx * block_size + bsy
+                    span = (block_run - 1) * step + 1
+                    for layer, base, im_getter, oy in runs:
+                        i = base + first
+                        if offsets[i] == offsets[i + span]:
+                            # no tiles in this run
+                            continue
+                        if self.block_sprites is not None:
+                            row = bsx + bsy
+                            sprite = self.block_row_sprite(
+                                c, index, layer, row, sqr_width)
+                            if sprite:
+                                x0 = max(0, row - step)
+                                tx = ox - (bsx - x0) * sqr_width
+                                sprite.render(im_getter.get(), tx, oy)
+                            continue
+                        tx = ox
+                        for _ in range(block_run):
+                            begin = offsets[i]
+                            end = offsets[i + 1]
+                            if end - begin > 1 and stacks is not None:
+                                tex = self.stack_texture(c, tiles[begin: end])
+                                if tex:
+                                    tex.render(im_getter.get(), tx, oy)
+                            elif begin != end:
+                                for t in tiles[begin: end]:
+                                    tex = textures[t]
+                                    if tex:
+                                        tex.render(im_getter.get(), tx, oy)
+                            i += step
+                            tx += sqr_width
+                    ox += block_run * sqr_width
 
 
 def color_from_sums(color_sums):
@@ -64,9 +314,9 @@ def color_from_sums(color_sums):
 def rc_base(tl, tiles, layer):
     base = next(iter(tiles), None)
     if base:
-        tx = tl.get_by_name(base)
-        if tx:
-            return color_from_sums([tx.get_color_sum()])
+        color_sum = tl.get_color_sum(base)
+        if color_sum:
+            return color_from_sums([color_sum])
     return None
 
 
@@ -82,11 +332,9 @@ def rc_base_water(tl, tiles, layer):
     color_sums = []
     for i, tile in enumerate(tiles):
         if i == 0 or tile in _half_water:
-            tx = tl.get_by_name(tile)
-            if tx:
-                color_sum = tx.get_color_sum()
-                if color_sum:
-                    color_sums.append(color_sum)
+            color_sum = tl.get_color_sum(tile)
+            if color_sum:
+                color_sums.append(color_sum)
             if i > 0:
                 break
     return color_from_sums(color_sums)
@@ -95,11 +343,9 @@ def rc_base_water(tl, tiles, layer):
 def rc_avg(tl, tiles, layer):
     color_sums = []
     for tile in tiles:
-        tx = tl.get_by_name(tile)
-        if tx:
-            color_sum = tx.get_color_sum()
-            if color_sum:
-                color_sums.append(color_sum)
+        color_sum = tl.get_color_sum(tile)
+        if color_sum:
+            color_sums.append(color_sum)
     return color_from_sums(color_sums)
 
 
@@ -149,15 +395,33 @@ _cs_pattern = {
 }
 
 
+# bit of each rule name in the carto-zed class of a tile
+_cz_bits = dict((rname, 1 << i) for i, rname in enumerate(sorted(_cs_pattern)))
+# tile name -> carto-zed class
+_cz_classes = {}
+
+
+def cartozed_class(name):
+    # bit mask of the carto-zed patterns matching the tile name
+    cz_class = _cz_classes.get(name)
+    if cz_class is None:
+        cz_class = 0
+        for rname, pattern in _cs_pattern.items():
+            if pattern.search(name):
+                cz_class |= _cz_bits[rname]
+        _cz_classes[name] = cz_class
+    return cz_class
+
+
 def rc_cartozed(tl, tiles, layer):
-    tiles = list(tiles)
+    classes = [cartozed_class(tile) for tile in tiles]
     rules = _cz_rules0 if layer == 0 else _cz_rules1
     for begin, end, color, rname in rules:
-        if end is None or end > len(tiles):
-            end = len(tiles)
-        pattern = _cs_pattern[rname]
+        if end is None or end > len(classes):
+            end = len(classes)
+        bit = _cz_bits[rname]
         for i in range(begin, end):
-            if pattern.search(tiles[i]):
+            if classes[i] & bit:
                 return color
     return None
 
@@ -174,10 +438,27 @@ class BaseTopRender(TextureRender):
         mode = options.get('top_view_color_mode', 'base+water')
         self.color = BaseTopRender.COLOR_FUNC[mode]
         self.input = options.get('input')
+        self.cell_cache = get_cell_cache(options)
         TextureRender.__init__(self, **options)
 
+    def layer_occupancy(self, dzi, cx, cy):
+        layer_range = dzi.render_minlayer, dzi.render_maxlayer
+        return cell_occupied_rects(self.input, cx, cy, layer_range,
+                                   self.cell_cache)
+
+    def preload(self, dzi, verbose=False, parallel=1):
+        # colors are looked up in the color tables written by unpack,
+        # only the textures missing from the tables are loaded
+        if self.color is rc_cartozed or not self.input:
+            return
+        table = self.tl.get_color_table()
+        names = [name for name in self.map_tile_names(dzi, parallel, verbose)
+                 if name not in table]
+        self.tl.preload(names, verbose)
+
     def tile(self, im_getter, dzi, cx, cy, layer):
-        c = cell.load_cell(self.input, cx, cy)
+        c = cell.load_cell(self.input, cx, cy, layer_range=(layer, layer + 1),
+                           cache=self.cell_cache)
         if not c:
             return
         draw = im_getter.get_draw()
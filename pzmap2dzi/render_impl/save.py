@@ -292,8 +292,6 @@ class SaveGameRender(SaveGameBase):
             tex = self.tl.get_by_name(tile_name)
             if tex:
                 tex.render(im_getter.get(), ox, oy)
-            else:
-                print('missing tile: {}'.format(s))
 
 
 class SaveGameTopRender(SaveGameBase):
@@ -3,6 +3,12 @@ from PIL import Image, ImageDraw
 import sys
 import time
 import datetime
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2
 from . import lru, mptask, util
 try:
     from . import shared_memory_image
@@ -69,6 +75,8 @@ class TopologicalDziScheduler(object):
         self.stopped = [0] * n
         self.gets = [0] * n
         self.hits = [0] * n
+        self.stats = [{}] * n
+        self.dedup = [(0, 0)] * n  # (linked, written) tiles of each worker
         tasks, done = task_info
         self.total = 0
         self.done = 0
@@ -117,10 +125,12 @@ class TopologicalDziScheduler(object):
 
     def on_result(self, wid, job, result):
         if result[0] == 'summary':
-            _, gets, hits = result
+            _, gets, hits, stats, dedup = result
             self.done_worker += 1
             self.gets[wid] = gets
             self.hits[wid] = hits
+            self.stats[wid] = stats
+            self.dedup[wid] = dedup
             if self.done_worker == self.n:
                 self.shutdown()
         else:
@@ -174,7 +184,9 @@ class TopologicalDziScheduler(object):
                 _, lm = value
             else:
                 if key in self.done_task:
-                    lm = [1] * self.dzi.layers
+                    lm = self.dzi.get_layer_map(*key)
+                    if lm is None:
+                        lm = [1] * self.dzi.layers
                 else:
                     lm = [0] * self.dzi.layers
             layer_maps.append(lm)
@@ -193,7 +205,8 @@ class TopologicalDziScheduler(object):
             if len(self.splits[wid]) > 0:
                 self.active[wid] = 1
                 job = self.splits[wid].pop()
-                job = job + (self.get_layer_maps(job),)
+                job = job + (self.get_layer_maps(job),
+                             self.dzi.get_layer_map(*job))
         if job == 'summary':
             self.active[wid] = 0
             self.active_worker -= 1
@@ -226,6 +239,20 @@ class TopologicalDziScheduler(object):
                 hits = sum(self.hits)
                 rate = 100*hits/gets
                 print('cache hit: {}/{} = {:.2f}%'.format(hits, gets, rate))
+        render_stats = {}
+        for stats in self.stats:
+            for name, (hits, misses) in stats.items():
+                total_hits, total_misses = render_stats.get(name, (0, 0))
+                render_stats[name] = total_hits + hits, total_misses + misses
+        for name, (hits, misses) in sorted(render_stats.items()):
+            gets = hits + misses
+            if gets:
+                rate = 100*hits/gets
+                print('{} cache hit: {}/{} = {:.2f}%'.format(name, hits, gets, rate))
+        linked = sum(linked for linked, written in self.dedup)
+        total = linked + sum(written for linked, written in self.dedup)
+        if total:
+            print('dedup linked: {}/{} tiles'.format(linked, total))
 
 
 def get_index(level, x, y, layer):
@@ -289,6 +316,99 @@ class CacheLoader(object):
             self.cached = set()
 
 
+class TileWriter(object):
+    # thread pool encoding and writing the tiles of a worker, pillow
+    # releases the GIL while encoding so the worker keeps rendering
+    # writes are grouped by key (level, x, y), at most queue_size writes
+    # wait for a thread and put blocks beyond that to cap memory
+    # a key with a failed write skips its callback (the tile stays pending)
+    # and its first error is raised by wait
+    def __init__(self, threads, queue_size):
+        self.queue = queue.Queue(max(1, queue_size))
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = {}
+        self.callbacks = {}
+        self.failed = {}  # key -> [exception, ...]
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def check(self, key=None):
+        # raise the first failed write of key, or of any key
+        # called with the lock held
+        if key is None and self.failed:
+            key = min(self.failed)
+        errors = self.failed.pop(key, None)
+        if errors:
+            raise errors[0]
+
+    def put(self, key, func, *args):
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + 1
+        self.queue.put((key, func, args))
+
+    def when_done(self, key, func):
+        # call func once the writes of key are done, unless one failed
+        with self.lock:
+            if key in self.pending:
+                self.callbacks[key] = func
+                return
+            if key in self.failed:
+                return
+        func()
+
+    def wait(self, key=None):
+        # wait for the writes of key, or all writes
+        with self.lock:
+            while (self.pending if key is None else key in self.pending):
+                self.idle.wait()
+            self.check(key)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            key, func, args = item
+            error = None
+            try:
+                func(*args)
+            except Exception as e:
+                print('Failed to write tile {}: {}'.format(key, e))
+                traceback.print_exc()
+                error = e
+            item = func = args = None
+            with self.lock:
+                if error is not None:
+                    self.failed.setdefault(key, []).append(error)
+                self.pending[key] -= 1
+                if self.pending[key] == 0:
+                    del self.pending[key]
+                    callback = self.callbacks.pop(key, None)
+                    if callback and key not in self.failed:
+                        try:
+                            callback()
+                        except Exception as e:
+                            print('Failed to complete tile {}: {}'.format(key, e))
+                            traceback.print_exc()
+                            self.failed[key] = [e]
+                    self.idle.notify_all()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+
+
 class TopologicalDziWorker(object):
     def __init__(self, dzi, prefix):
         if dzi.cache_enabled and shared_memory_image:
@@ -299,42 +419,76 @@ class TopologicalDziWorker(object):
         self.dzi = dzi
         self.gets = 0
         self.hits = 0
+        self.writer = None
 
     def init(self, context=None):
+        if self.dzi.encoder_threads > 0:
+            self.writer = TileWriter(self.dzi.encoder_threads,
+                                     self.dzi.encoder_queue)
         return True
 
+    def cleanup(self):
+        if self.writer:
+            self.writer.close()
+
     def on_msg(self, msg):
         if self.mem is None:
             return
         cmd, key = msg
         level, x, y = key
+        if self.writer:
+            # images being written live in the shared memory
+            self.writer.wait(key)
+        layers = []
+        saved = False
         for layer in range(self.dzi.minlayer, self.dzi.maxlayer):
             index = get_index(level, x, y, layer)
             state = self.cache_map.pop((level, x, y, layer), 'empty')
             if state == 'empty':
                 continue
+            layers.append(layer)
             if cmd == 'save' and state == 'skip':
                 im = self.mem.load(index)
                 self.dzi.save_tile(im, level, x, y, layer, force=True)
                 im = None
+                saved = True
             self.mem.release(index)
+        if saved:
+            self.dzi.clear_wip(level, x, y, layers)
 
     def on_job(self, job):
         if job == 'summary':
-            return 'summary', self.gets, self.hits
-        level, x, y, sub_layer_maps = job
+            if self.writer:
+                self.writer.wait()
+            stats = {}
+            if hasattr(self.dzi.render, 'get_stats'):
+                stats = self.dzi.render.get_stats()
+            dedup = (0, 0)
+            if self.dzi.dedup:
+                dedup = tuple(self.dzi.dedup.stats)
+            return 'summary', self.gets, self.hits, stats, dedup
+        level, x, y, sub_layer_maps, occupied = job
         size = (self.dzi.tile_size, self.dzi.tile_size)
         is_base = (level == self.dzi.levels - 1)
         cl = CacheLoader(self.mem, size)
         layer_map = [0] * self.dzi.layers
         layer_cache = [None] * self.dzi.layers
+        skipped = False
         self.dzi.set_wip(level, x, y)
+        ics = {}
         for layer in range(self.dzi.render_minlayer, self.dzi.render_maxlayer):
             index = get_index(level, x, y, layer)
-            ic = ImageCreater(self.mem, index, size)
-            if is_base:
-                self.dzi.render_tile(ic, x, y, layer, layer_cache)
-            else:
+            ics[layer] = ImageCreater(self.mem, index, size)
+        # images of the layers without content are never created
+        layers = self.dzi.render_layers(occupied)
+        if is_base:
+            self.dzi.render_tile_layers(
+                dict((layer, ics[layer]) for layer in layers),
+                x, y, layer_cache)
+        for layer in range(self.dzi.render_minlayer, self.dzi.render_maxlayer):
+            index = get_index(level, x, y, layer)
+            ic = ics.pop(layer)
+            if not is_base and layer in layers:
                 cached = []
                 depend_tasks = depend_task(level, x, y)
                 for pos, (sub_level, sub_x, sub_y) in enumerate(depend_tasks):
@@ -346,7 +500,8 @@ class TopologicalDziWorker(object):
                 cached = []
 
             force = self.mem is None
-            state = self.dzi.save_tile(ic.im, level, x, y, layer, force)
+            state = self.dzi.save_tile(ic.im, level, x, y, layer, force,
+                                       self.writer)
 
             if state == 'empty':
                 if self.mem is not None:
@@ -356,15 +511,32 @@ class TopologicalDziWorker(object):
                 if self.mem is not None:
                     self.cache_map[(level, x, y, layer)] = state
                 layer_map[layer] = 1
+                skipped = skipped or state == 'skip'
             layer_cache[layer] = ic.im
             ic.release_reference()
 
-        if not layer_map[0]:
-            self.dzi.mark_empty(level, x, y, 0)
         layer_cache = None
 
         self.gets += cl.gets
         self.hits += cl.hits
+        if self.writer and not is_base:
+            # children rendered by this worker are released here
+            for key in depend_task(level, x, y):
+                self.writer.wait(key)
         cl.cleanup()
-        self.dzi.clear_wip(level, x, y)
+        # a tile kept unwritten in the cache is done once saved, see on_msg
+        layers = None
+        if not skipped:
+            layers = [layer for layer in range(self.dzi.render_minlayer,
+                                               self.dzi.render_maxlayer)
+                      if layer_map[layer]]
+        if self.writer:
+            # the tile stays pending until written, without the cache the
+            # parent tile reads it from disk, wait for it then
+            self.writer.when_done((level, x, y), lambda: self.dzi.clear_wip(
+                level, x, y, layers))
+            if self.mem is None:
+                self.writer.wait((level, x, y))
+        else:
+            self.dzi.clear_wip(level, x, y, layers)
         return level, x, y, layer_map
@@ -40,7 +40,10 @@ class ImageSharedMemory(object):
                 return None
             self.loaded[index] = shm
         if width * height == 0 and size_func:
-            width, height = size_func(shm)
+            size = size_func(shm)
+            if size is None:
+                return None
+            width, height = size
         return _buffered_image(shm, width, height, self.extra_size)
 
     def get_extra(self, index):
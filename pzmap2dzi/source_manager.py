@@ -53,6 +53,18 @@ def _file_digest(path, hash_algo, chunk_size=1024 * 1024):
     return hasher.hexdigest()
 
 
+def stat_signature(paths, hash_algo=None):
+    # signature of a group of files from their size and mtime (and digest)
+    parts = []
+    for path in paths:
+        st = os.stat(path)
+        part = '{}:{}:{}'.format(os.path.basename(path), st.st_size, st.st_mtime)
+        if hash_algo:
+            part += ':' + _file_digest(path, hash_algo)
+        parts.append(part)
+    return ';'.join(parts)
+
+
 class SignatureCollector:
     def __init__(self, patterns, mode=SIGNATURE_MTIME, hash_algo='sha256', progress=True):
         if mode < 0 or mode > SIGNATURE_MAX:
@@ -1,74 +1,151 @@
 from __future__ import print_function
-from PIL import Image
+from PIL import Image, ImageStat
 from PIL.PngImagePlugin import PngInfo
 import PIL
 import io
 import os
+import mmap
 import re
 import struct
 import time
 import yaml
+import json
 import hashlib
 
 if __package__ is not None:
-    from . import mptask, binfile, util, plants
+    from . import mptask, binfile, util, plants, texture_atlas
+    from . import source_manager
 
 try:
     from . import shared_memory_image
 except ImportError:
     shared_memory_image = None
 
+# color sums of each texture, written next to the unpacked textures
+COLOR_TABLE_NAME = 'colors.json'
+# names of the png textures of a folder, written by unpack
+MANIFEST_NAME = 'textures.json'
+# folder of the blended plant textures, in the first texture path
+PLANTS_FOLDER = 'plants'
+# plant atlases not used for this long are removed when a new one is saved
+PLANTS_KEEP_DAYS = 30
 
-def read_texture(data, pos):
+# alpha types of textures, decide how a texture is drawn
+OPAQUE = 0  # plain paste
+BINARY_ALPHA = 1  # paste with its alpha as mask
+ALPHA = 2  # alpha composite
+
+
+TEXTURE_FIELDS = ('x', 'y', 'w', 'h', 'ox', 'oy', 'ow', 'oh')
+TEXTURE_STRUCT = struct.Struct('8i')
+
+
+def read_texture(reader):
     texture = {}
-    name, pos = util.read_bytes_with_length(data, pos)
-    texture['name'] = name.decode('utf8')
-    texture['x'], pos = util.read_int32(data, pos)
-    texture['y'], pos = util.read_int32(data, pos)
-    texture['w'], pos = util.read_int32(data, pos)
-    texture['h'], pos = util.read_int32(data, pos)
-    texture['ox'], pos = util.read_int32(data, pos)
-    texture['oy'], pos = util.read_int32(data, pos)
-    texture['ow'], pos = util.read_int32(data, pos)
-    texture['oh'], pos = util.read_int32(data, pos)
-    return texture, pos
-
-
-def read_page(data, pos, version):
+    texture['name'] = reader.bytes_with_length().decode('utf8')
+    texture.update(zip(TEXTURE_FIELDS, reader.unpack(TEXTURE_STRUCT)))
+    return texture
+
+
+def read_page(reader, version, load_png=True):
+    # load_png: False to only keep the (start, end) range of the png data
+    #           in page['png_range']
     page = {}
-    page['name'], pos = util.read_bytes_with_length(data, pos)
-    count, pos = util.read_uint32(data, pos)
-    page['has_alpha'], pos = util.read_uint32(data, pos)
-    textures = []
-    for i in range(count):
-        texture, pos = read_texture(data, pos)
-        textures.append(texture)
-    page['textures'] = textures
+    page['name'] = reader.bytes_with_length()
+    count, page['has_alpha'] = reader.values('I', 2)
+    page['textures'] = [read_texture(reader) for i in range(count)]
     if version == 0:
-        # magic 0xdeadbeef little endian
-        page['png'], pos = util.read_until(data, pos, b'\xef\xbe\xad\xde')
+        # magic 0xdeadbeef little endian, found without copying the png
+        start = reader.pos
+        end = reader.data.find(b'\xef\xbe\xad\xde', start)
+        if end < 0:
+            raise ValueError('Page end not found')
+        reader.seek(end + 4)
     elif version == 1:
-        page['png'], pos = util.read_bytes_with_length(data, pos)
+        length = reader.uint32()
+        start = reader.pos
+        reader.skip(length)
     else:
         print('Unsupported pack version {}'.format(version))
-
-    return page, pos
-
-
-def load_pack(path):
-    data = b''
+        return page
+    page['png_range'] = start, reader.pos
+    if load_png:
+        page['png'] = reader.data[start: reader.pos]
+    return page
+
+
+def map_pack(path):
+    # (version, pages) of a pack parsed from the memory mapped file, the
+    # pngs are not decoded
+    # page['png'] and page['record'] (the whole page) are zero-copy views
+    # of the file, which stays mapped while any of them is referenced
+    if os.path.getsize(path) == 0:
+        return None, []
     with open(path, 'rb') as f:
-        data = f.read()
-    version, pos = binfile.get_version(data, 0, b'PZPK', (0, 0))
-    page_num, pos = util.read_uint32(data, pos)
-    print('{}: version {}, {} pages'.format(path, version, page_num))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    reader = util.BinaryReader(data)
+    version = binfile.get_version(reader, b'PZPK', 0)
+    page_num = reader.uint32()
     pages = []
     for i in range(page_num):
-        page, pos = read_page(data, pos, version)
+        start = reader.pos
+        page = read_page(reader, version, False)
+        if 'png_range' not in page:
+            break
+        png_start, png_end = page['png_range']
+        page['png'] = view[png_start: png_end]
+        page['record'] = view[start: reader.pos]
         pages.append(page)
+    print('{}: version {}, {} pages'.format(path, version, page_num))
+    return version, pages
+
+
+def load_pack(path):
+    version, pages = map_pack(path)
     return pages
 
 
+def index_pack(path):
+    # [(page key, page)] of a pack without the png data,
+    # page['hash'] is the md5 of the whole page record
+    version, pages = map_pack(path)
+    result = []
+    keys = set()
+    for i, page in enumerate(pages):
+        page['hash'] = hashlib.md5(page.pop('record')).hexdigest()
+        del page['png']
+        key = page['name'].decode('utf8')
+        if key in keys:
+            key = '{}#{}'.format(key, i)
+        keys.add(key)
+        result.append((key, page))
+    return result
+
+
+def pz_packs(pzmain):
+    files = [
+        'Erosion.pack',
+        'ApCom.pack',
+        'RadioIcons.pack',
+        'ApComUI.pack',
+        'JumboTrees2x.pack',
+        'Tiles2x.floor.pack',
+        'Tiles2x.pack',
+    ]
+    packs = os.path.join(pzmain, 'media', 'texturepacks')
+    return [os.path.join(packs, f) for f in files]
+
+
+def crop_texture(im, t):
+    # texture t (from read_texture) of a decoded page image
+    x, y, w, h = t['x'], t['y'], t['w'], t['h']
+    ox, oy, ow, oh = t['ox'], t['oy'], t['ow'], t['oh']
+    ox -= ow >> 1
+    oy -= oh
+    return Texture(im.crop((x, y, x + w, y + h)), (ox, oy))
+
+
 def color_sum(pixels):
     total = len(pixels)
     if total > 0:
@@ -77,23 +154,81 @@ def color_sum(pixels):
     return 0, 0, 0, 1
 
 
+def image_color_sum(im):
+    # same as color_sum of the opaque pixels of an RGBA image
+    if im.size[0] == 0 or im.size[1] == 0:
+        return 0, 0, 0, 1
+    mask = im.getchannel('A').point(lambda a: 255 if a == 255 else 0)
+    stat = ImageStat.Stat(im, mask)
+    total = stat.count[0]
+    if total == 0:
+        return 0, 0, 0, 1
+    r, g, b = map(int, stat.sum[:3])
+    return r, g, b, total
+
+
+def alpha_type(im):
+    if im.mode != 'RGBA' or im.size[0] == 0 or im.size[1] == 0:
+        return ALPHA
+    hist = im.getchannel('A').histogram()
+    if not any(hist[:255]):
+        return OPAQUE
+    if not any(hist[1:255]):
+        return BINARY_ALPHA
+    return ALPHA
+
+
+def save_manifest(path):
+    # names of the png textures of path, with the modified time of the
+    # folder they were listed at
+    manifest = os.path.join(path, MANIFEST_NAME)
+    # create the manifest and the plants folder before listing, rewriting
+    # the manifest in place or adding plant textures does not modify the
+    # folder
+    with open(manifest, 'a'):
+        pass
+    util.ensure_folder(os.path.join(path, PLANTS_FOLDER))
+    mtime = os.stat(path).st_mtime
+    names = sorted(f[:-4] for f in os.listdir(path) if f.endswith('.png'))
+    with open(manifest, 'w') as f:
+        json.dump({'mtime': mtime, 'names': names}, f)
+
+
+def load_manifest(path):
+    # names of the png textures of path, the manifest is ignored when
+    # files were added or removed after it was written
+    try:
+        manifest = util.load_json(os.path.join(path, MANIFEST_NAME))
+        if manifest and manifest.get('mtime') == os.stat(path).st_mtime:
+            return manifest['names']
+    except Exception as e:
+        pass
+    if not os.path.isdir(path):
+        return []
+    return [f[:-4] for f in os.listdir(path) if f.endswith('.png')]
+
+
 def gethash(path, method='md5'):
+    hasher = getattr(hashlib, method)()
     with io.open(path, 'rb') as f:
-        data = f.read()
-        hasher = getattr(hashlib, method)()
-        hasher.update(data)
-        return ':'.join((method, hasher.hexdigest()))
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return ':'.join((method, hasher.hexdigest()))
 
 
 class Texture(object):
-    def __init__(self, im, offset=None):
+    def __init__(self, im, offset=None, trimmed=False):
         # offset is from the bottom center of the square
+        # trimmed: im is already cropped to its bounding box
         if offset:
             ox, oy = offset
         else:
             ox = int(im.info.get('ox', 0))
             oy = int(im.info.get('oy', 0))
-        bbox = im.getbbox()
+        if trimmed:
+            bbox = (0, 0) + im.size
+        else:
+            bbox = im.getbbox()
         if bbox is None:
             self.im = Image.new('RGBA', (0, 0))
             self.ox = 0
@@ -106,43 +241,55 @@ class Texture(object):
             self.im = im
             self.ox = ox
             self.oy = oy
+        self.alpha = alpha_type(self.im)
         self.color_sum = None
 
     if tuple(map(int, PIL.__version__.split('.'))) >= (10, 4, 0):
-        def render(self, target, x, y):
-            x = x + self.ox
-            y = y + self.oy
+        def composite(self, target, x, y):
             target.alpha_composite(self.im, (x, y))
     else:
-        def render(self, target, x, y):
+        def composite(self, target, x, y):
             w, h = self.im.size
-            x = x + self.ox
-            y = y + self.oy
             base = target.crop((x, y, x + w, y + h))
             result = Image.alpha_composite(base, self.im)
             target.paste(result, (x, y))
 
+    def render(self, target, x, y):
+        # same result as alpha compositing, except for the color of fully
+        # transparent pixels
+        x = x + self.ox
+        y = y + self.oy
+        if self.alpha == OPAQUE:
+            target.paste(self.im, (x, y))
+        elif self.alpha == BINARY_ALPHA:
+            target.paste(self.im, (x, y), self.im)
+        else:
+            self.composite(target, x, y)
+
     def get_color_sum(self):
         if self.color_sum is None:
-            pixels = list(filter(lambda x: x[3] == 255, self.im.getdata()))
-            self.color_sum = color_sum(pixels)
+            self.color_sum = image_color_sum(self.im)
         return self.color_sum
 
     def save(self, path):
         metadata = PngInfo()
         metadata.add_text('ox', str(self.ox))
         metadata.add_text('oy', str(self.oy))
-        self.im.save(path, pnginfo=metadata)
+        im = self.im
+        if im.size[0] == 0 or im.size[1] == 0:
+            # png can not store an empty image, a transparent pixel is
+            # trimmed back to an empty texture when loaded
+            im = Image.new('RGBA', (1, 1))
+        im.save(path, pnginfo=metadata)
 
 
 class TextureLibrary(object):
     @staticmethod
     def get_size(shm):
-        while shm.buf[0] != 1:
-            # spin lock wait
-            # time.sleep(0.1)
-            pass
-
+        # None while another worker is still writing the texture,
+        # the caller then loads its own copy instead of waiting
+        if shm.buf[0] != 1:
+            return None
         w, h = struct.unpack('ii', shm.buf[4:12])
         return w, h
 
@@ -156,6 +303,20 @@ class TextureLibrary(object):
         self.page_buffer = None
         self.mapping = {}
         self.mem = None
+        # texture path -> TextureAtlas, opened on first use
+        self.atlases = {}
+        # names of the textures mapped from atlases
+        self.mapped = set()
+        # texture name -> folder of its png file, built on first use,
+        # names not in the index are missing
+        self.index = None
+        # texture name -> color sum, loaded on first use
+        self.color_table = None
+        # plant texture name -> names of the textures blended into it
+        self.plants = {}
+        # atlas of the blended plant textures, opened on first use
+        self.plants_atlas_path = None
+        self.plants_atlas = None
         if self.use_cache and shared_memory_image:
             prefix = 'tl.{}.{}'.format(os.getpid(), cache_name)
             self.mem = shared_memory_image.ImageSharedMemory(prefix, 32)
@@ -189,41 +350,85 @@ class TextureLibrary(object):
                 self.page.append(im)
             for t in page['textures']:
                 name = t['name']
-                x, y, w, h = t['x'], t['y'], t['w'], t['h']
-                ox, oy, ow, oh = t['ox'], t['oy'], t['ow'], t['oh']
-                ox -= ow >> 1
-                oy -= oh
-                texture = Texture(im.crop((x, y, x + w, y + h)), (ox, oy))
+                texture = crop_texture(im, t)
                 if debug and self.lib.get(name, None):
                     print('Conflict texture: {}'.format(name))
                 self.lib[name] = texture
                 if self.page_mode:
-                    self.mapping[name] = page_id, x, y, w, h, ox, oy
+                    self.mapping[name] = (page_id, t['x'], t['y'], t['w'],
+                                          t['h'], texture.ox, texture.oy)
 
     def add_from_pz_path(self, pzmain, debug=False):
-        files = [
-            'Erosion.pack',
-            'ApCom.pack',
-            'RadioIcons.pack',
-            'ApComUI.pack',
-            'JumboTrees2x.pack',
-            'Tiles2x.floor.pack',
-            'Tiles2x.pack',
-        ]
-        packs = os.path.join(pzmain, 'media', 'texturepacks')
-        for f in files:
-            self.add_pack(os.path.join(packs, f), debug)
+        for path in pz_packs(pzmain):
+            self.add_pack(path, debug)
 
     def set_texture_path(self, path):
         self.texture_path = path
+        self.index = None
+
+    def get_atlas(self, path):
+        if path not in self.atlases:
+            atlas = None
+            atlas_path = texture_atlas.atlas_path(path)
+            if os.path.isfile(atlas_path):
+                try:
+                    atlas = texture_atlas.TextureAtlas(atlas_path)
+                except Exception as e:
+                    print('Failed to load texture atlas {}: {}'.format(atlas_path, e))
+            self.atlases[path] = atlas
+        return self.atlases[path]
+
+    def load_from_atlas(self, name):
+        # atlases are memory mapped and shared by all workers,
+        # no need to copy their textures to the shared memory cache
+        for path in self.texture_path:
+            atlas = self.get_atlas(path)
+            if atlas is not None and name in atlas:
+                im, offset = atlas.get_image(name)
+                return Texture(im, offset, True)
+        return None
+
+    def get_color_table(self):
+        if self.color_table is None:
+            self.color_table = {}
+            # the first texture path takes precedence, as in load_texture
+            for path in reversed(self.texture_path):
+                table = util.load_json(os.path.join(path, COLOR_TABLE_NAME))
+                if table:
+                    self.color_table.update(table)
+        return self.color_table
+
+    def get_color_sum(self, name):
+        # loaded textures (e.g. blended plants) come first, then the color
+        # tables, the texture is only loaded when missing from both
+        if name not in self.lib and name not in self.plants:
+            sums = self.get_color_table().get(name)
+            if sums is not None:
+                return tuple(sums)
+        t = self.get_by_name(name)
+        if t is None:
+            return None
+        return t.get_color_sum()
+
+    def get_index(self):
+        if self.index is None:
+            self.index = {}
+            # the first texture path takes precedence
+            for path in reversed(self.texture_path):
+                for name in load_manifest(path):
+                    self.index[name] = path
+        return self.index
 
     def load_raw_texture(self, name):
-        for path in self.texture_path:
-            file_path = os.path.join(path, name + '.png')
-            if os.path.exists(file_path):
-                im = Image.open(file_path)
-                if im:
-                    return Texture(im)
+        path = self.get_index().get(name)
+        if path is None:
+            return None
+        try:
+            im = Image.open(os.path.join(path, name + '.png'))
+        except (IOError, OSError) as e:
+            return None
+        if im:
+            return Texture(im)
 
     def load_from_cache(self, name):
         t = None
@@ -279,6 +484,17 @@ class TextureLibrary(object):
                         buf_im.paste(im, (0, 0))
 
     def load_texture(self, name):
+        if name in self.plants:
+            t = self.load_plant(name)
+            self.lib[name] = t
+            return t
+
+        t = self.load_from_atlas(name)
+        if t is not None:
+            self.lib[name] = t
+            self.mapped.add(name)
+            return t
+
         t = self.load_from_cache(name)
 
         if t is None:
@@ -297,21 +513,81 @@ class TextureLibrary(object):
 
         return self.load_texture(name)
 
-    def save_all(self, path, parallel=1):
+    def has_texture(self, name):
+        # without loading the texture
+        if name in self.lib:
+            return self.lib[name] is not None
+        if name in self.plants:
+            return True
+        for path in self.texture_path:
+            atlas = self.get_atlas(path)
+            if atlas is not None and name in atlas:
+                return True
+        return name in self.get_index()
+
+    def set_missing(self, names):
+        # known missing textures are not looked up (nor reported) again
+        for name in names:
+            self.lib[name] = None
+
+    def preload(self, names, verbose=False):
+        # load textures before workers start, so they are shared by all
+        # workers (copy-on-write, or shared memory when cache is enabled)
+        # skipped for spawned workers, each would unpickle a copy of them
+        if not mptask.workers_forked():
+            return
+        names = [name for name in sorted(names) if name not in self.lib]
+        total = len(names)
+        progress_display = util.ProgressDisplay('Preloading textures: {progress} / {total}' if verbose else '')
+        for progress, name in enumerate(names, start=1):
+            progress_display.update(progress=progress, total=total)
+            self.load_texture(name)
+        progress_display.finish(progress=total, total=total)
+
+    def get_color_sums(self):
+        sums = {}
+        for name, t in self.lib.items():
+            if t is not None:
+                sums[name] = t.get_color_sum()
+        return sums
+
+    def save_atlas(self, path):
+        # textures of an existing atlas that are not replaced are kept,
+        # as unchanged packs are skipped by add_pack
+        if not self.lib:
+            return
+        textures = []
+        for name in sorted(self.lib):
+            t = self.lib[name]
+            if t is not None:
+                textures.append((name, t.im, t.ox, t.oy))
+        update_atlas(path, textures, self.get_color_sums())
+
+    def save_color_table(self, path):
+        update_color_table(path, self.get_color_sums())
+
+    def save_all(self, path, parallel=1, atlas=False):
         if not util.ensure_folder(path):
             return False
-        if self.page_mode:
+        if atlas:
+            self.save_atlas(path)
+            tasks = []
+        elif self.page_mode:
             tasks = list(enumerate(self.page))
             with open(os.path.join(path, 'mapping.yaml'), 'w') as f:
                 f.write(yaml.safe_dump(self.mapping))
         else:
             tasks = list(self.lib.items())
-        if not tasks:
+            self.save_color_table(path)
+        if tasks:
+            t = mptask.Task(SaveImg(path), True)
+            t.run(tasks, parallel)
+        elif not atlas:
             return
-        t = mptask.Task(SaveImg(path), True)
-        t.run(tasks, parallel)
         with open(os.path.join(path, 'hash.yaml'), 'w') as f:
             f.write(yaml.safe_dump(self.hash))
+        if not (atlas or self.page_mode):
+            save_manifest(path)
 
     def blend_textures(self, names):
         w, h = 384, 512
@@ -324,10 +600,90 @@ class TextureLibrary(object):
                 t.render(im, x, y)
         return Texture(im, (-x, -y))
 
+    def plants_signature(self):
+        # blended textures depend on the plant mapping and the unpacked
+        # textures they are blended from, known by the content of hash.yaml
+        # (rewritten by each unpack, its stat changes even without updates)
+        # or the stat of a texture atlas without it
+        # folders are hashed in sorted order, the signature does not depend
+        # on the order of texture_path
+        mapping = json.dumps(sorted(self.plants.items()))
+        h = hashlib.md5(mapping.encode('utf8'))
+        for path in sorted(self.texture_path):
+            hash_path = os.path.join(path, 'hash.yaml')
+            atlas_path = texture_atlas.atlas_path(path)
+            h.update('|{}|'.format(path).encode('utf8'))
+            if os.path.isfile(hash_path):
+                with open(hash_path, 'rb') as f:
+                    h.update(f.read())
+            elif os.path.isfile(atlas_path):
+                signature = source_manager.stat_signature([atlas_path])
+                h.update(signature.encode('utf8'))
+        return h.hexdigest()
+
+    def save_plants(self, path):
+        textures = []
+        for key in sorted(self.plants):
+            t = self.blend_textures(self.plants[key])
+            self.lib[key] = t
+            textures.append((key, t.im, t.ox, t.oy))
+        try:
+            texture_atlas.save_atlas(path, textures)
+        except Exception as e:
+            print('Failed to save plant textures {}: {}'.format(path, e))
+
+    def get_plants_atlas(self):
+        if self.plants_atlas is None and self.plants_atlas_path:
+            try:
+                self.plants_atlas = texture_atlas.TextureAtlas(
+                    self.plants_atlas_path)
+            except Exception as e:
+                print('Failed to load plant textures {}: {}'.format(
+                    self.plants_atlas_path, e))
+                self.plants_atlas_path = None
+        return self.plants_atlas
+
+    def load_plant(self, name):
+        atlas = self.get_plants_atlas()
+        if atlas is not None and name in atlas:
+            im, offset = atlas.get_image(name)
+            self.mapped.add(name)
+            return Texture(im, offset, True)
+        return self.blend_textures(self.plants[name])
+
     def config_plants(self, conf):
+        # plant textures are blended once for each plants conf and kept in
+        # an atlas in the first texture path, later runs and workers map
+        # them on first use
         pi = plants.PlantsInfo(conf)
-        for key, names in pi.mapping.items():
-            self.lib[key] = self.blend_textures(names)
+        self.plants = pi.mapping
+        if not self.texture_path:
+            for key, names in self.plants.items():
+                self.lib[key] = self.blend_textures(names)
+            return
+        folder = os.path.join(self.texture_path[0], PLANTS_FOLDER)
+        path = os.path.join(folder, '{}.atlas'.format(self.plants_signature()))
+        if os.path.isfile(path):
+            # the mtime of an atlas is its last use, see remove_stale_plants
+            try:
+                os.utime(path, None)
+            except OSError as e:
+                pass
+        elif util.ensure_folder(folder):
+            self.save_plants(path)
+            remove_stale_plants(folder, path)
+        self.plants_atlas_path = path
+
+    def __getstate__(self):
+        # memory mapped atlases can not be pickled (e.g. for spawned
+        # workers), they are mapped again on first use
+        state = self.__dict__.copy()
+        state['atlases'] = {}
+        state['plants_atlas'] = None
+        state['lib'] = dict((name, t) for name, t in self.lib.items()
+                            if name not in self.mapped)
+        state['mapped'] = set()
+        return state
 
     def __del__(self):
         if self.mem is not None:
@@ -335,6 +691,220 @@ class TextureLibrary(object):
             self.mem.clear()
 
 
+def remove_stale_plants(folder, path):
+    # one atlas is kept for each signature (plants conf and texture
+    # folders), shared by the renders of all maps, only the atlases not
+    # used for PLANTS_KEEP_DAYS are removed
+    expire = time.time() - PLANTS_KEEP_DAYS * 24 * 3600
+    for name in os.listdir(folder):
+        stale = os.path.join(folder, name)
+        if not name.endswith('.atlas') or stale == path:
+            continue
+        try:
+            if os.stat(stale).st_mtime >= expire:
+                continue
+            os.remove(stale)
+        except OSError as e:
+            print('Failed to remove plant textures {}: {}'.format(stale, e))
+
+
+def update_color_table(path, sums, kept=None):
+    # color sums of the opaque pixels of each texture, so the top view
+    # color modes do not have to load the textures
+    # sums: {name: color sum} of the new textures
+    # kept: [(name, im)] of saved textures not replaced, None to keep the
+    #       entries of the existing png files
+    table_path = os.path.join(path, COLOR_TABLE_NAME)
+    old = util.load_json(table_path) or {}
+    if kept is None:
+        kept = []
+        for name in old:
+            if name not in sums and os.path.isfile(
+                    os.path.join(path, name + '.png')):
+                kept.append((name, None))
+    table = {}
+    for name, im in kept:
+        color = old.get(name)
+        if color is None and im is not None:
+            color = image_color_sum(im)
+        if color is not None:
+            table[name] = list(color)
+    for name, color in sums.items():
+        table[name] = list(color)
+    util.save_json_compact(table_path, table)
+
+
+def update_atlas(path, textures, sums):
+    # write the atlas of path with textures replacing the old ones,
+    # textures of the existing atlas that are not replaced are kept
+    # textures: [(name, im, ox, oy)]
+    # sums: {name: color sum} of textures
+    atlas_path = texture_atlas.atlas_path(path)
+    old = None
+    if os.path.isfile(atlas_path):
+        try:
+            old = texture_atlas.TextureAtlas(atlas_path)
+        except Exception as e:
+            print('Failed to load texture atlas {}: {}'.format(atlas_path, e))
+    kept = []
+    if old is not None:
+        for name in sorted(old.names()):
+            if name not in sums:
+                im, (ox, oy) = old.get_image(name)
+                kept.append((name, im, ox, oy))
+    update_color_table(path, sums, [(name, im) for name, im, _, _ in kept])
+    textures = kept + textures
+    kept = None
+    count = len(textures)
+    if old is not None:
+        # the atlas is written to a temporary file first, so the old
+        # textures are still readable while saving
+        texture_atlas.save_atlas(atlas_path + '.new', textures)
+        textures = None
+        im = None
+        old.close()
+        os.remove(atlas_path)
+        os.rename(atlas_path + '.new', atlas_path)
+    else:
+        texture_atlas.save_atlas(atlas_path, textures)
+    print('{}: {} textures'.format(atlas_path, count))
+
+
+class UnpackPages(object):
+    # decodes a page read by offset from its pack file and writes the
+    # textures it provides, as png files or as a partial atlas
+    def __init__(self, path):
+        self.path = path
+
+    def on_job(self, job):
+        pack, png_range, textures, part = job
+        start, end = png_range
+        with open(pack, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        im = Image.open(io.BytesIO(data))
+        if im.mode != 'RGBA':
+            im = im.convert('RGBA')
+        sums = {}
+        entries = []
+        for t in textures:
+            name = t['name']
+            texture = crop_texture(im, t)
+            sums[name] = texture.get_color_sum()
+            if part:
+                entries.append((name, texture.im, texture.ox, texture.oy))
+            else:
+                texture.save(os.path.join(self.path, '{}.png'.format(name)))
+        if part:
+            texture_atlas.save_atlas(part, entries)
+        return sums
+
+
+def unpack_packs(packs, path, parallel=1, atlas=False, debug=False):
+    # unpack the textures of packs to path, later packs override textures
+    # of the same name
+    # only pages changed since the last unpack are decoded, by workers
+    # reading the pages from the pack files and writing the textures
+    if not util.ensure_folder(path):
+        return False
+    hash_path = os.path.join(path, 'hash.yaml')
+    old_hash = {}
+    if os.path.isfile(hash_path):
+        with io.open(hash_path, 'r') as f:
+            old_hash = yaml.safe_load(f) or {}
+
+    pages = []
+    owner = {}
+    for pack in packs:
+        if not os.path.isfile(pack):
+            continue
+        for key, page in index_pack(pack):
+            for t in page['textures']:
+                if debug and t['name'] in owner:
+                    print('Conflict texture: {}'.format(t['name']))
+                owner[t['name']] = len(pages)
+            pages.append((pack, key, page))
+
+    atlas_path = texture_atlas.atlas_path(path)
+    saved_names = None
+    if atlas and os.path.isfile(atlas_path):
+        try:
+            old = texture_atlas.TextureAtlas(atlas_path)
+            saved_names = set(old.names())
+            old.close()
+        except Exception as e:
+            pass
+
+    def saved(name):
+        if atlas:
+            return saved_names is not None and name in saved_names
+        return os.path.isfile(os.path.join(path, '{}.png'.format(name)))
+
+    new_hash = {}
+    tasks = []
+    for i, (pack, key, page) in enumerate(pages):
+        textures = [t for t in page['textures'] if owner[t['name']] == i]
+        # the page is also redone when the textures it provides change,
+        # e.g. a later page overriding them is removed
+        names = '\n'.join(t['name'] for t in textures).encode('utf8')
+        signature = '{}:{}'.format(page['hash'],
+                                   hashlib.md5(names).hexdigest())
+        new_hash.setdefault(pack, {})[key] = signature
+        old = old_hash.get(pack)
+        if not textures:
+            continue
+        if (isinstance(old, dict) and old.get(key) == signature and
+                all(saved(t['name']) for t in textures)):
+            continue
+        part = None
+        if atlas:
+            part = '{}.part{}'.format(atlas_path, len(tasks))
+        tasks.append(((pack, page['png_range'], textures, part), pack, key))
+    print('{}: {}/{} pages changed'.format(path, len(tasks), len(pages)))
+
+    sums = {}
+    parts = []
+    if tasks:
+        t = mptask.Task(UnpackPages(path), True)
+        results = t.run([job for job, _, _ in tasks], parallel)
+        for (job, pack, key), result in zip(tasks, results):
+            if isinstance(result, dict):
+                sums.update(result)
+                if job[3]:
+                    parts.append(job[3])
+            else:
+                # failed, retried by the next unpack
+                new_hash[pack].pop(key, None)
+
+    if atlas:
+        if parts or saved_names is None:
+            opened = []
+            textures = []
+            for part in parts:
+                part_atlas = texture_atlas.TextureAtlas(part)
+                opened.append(part_atlas)
+                for name in part_atlas.names():
+                    im, (ox, oy) = part_atlas.get_image(name)
+                    textures.append((name, im, ox, oy))
+            textures.sort(key=lambda t: t[0])
+            update_atlas(path, textures, sums)
+            textures = None
+            im = None
+            for part_atlas in opened:
+                part_atlas.close()
+        for job, _, _ in tasks:
+            if job[3] and os.path.isfile(job[3]):
+                os.remove(job[3])
+    elif sums:
+        update_color_table(path, sums)
+
+    with open(hash_path, 'w') as f:
+        f.write(yaml.safe_dump(new_hash))
+    if not atlas:
+        save_manifest(path)
+    return True
+
+
 class SaveImg(object):
     def __init__(self, path):
         self.path = path
@@ -353,21 +923,27 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--mp', type=int, default=1)
     parser.add_argument('-z', '--pz-path', type=str, default='')
     parser.add_argument('-p', '--page-mode', action='store_true')
+    parser.add_argument('-a', '--atlas', action='store_true')
     parser.add_argument('packs', nargs=argparse.REMAINDER)
     args = parser.parse_args()
 
-    lib = TextureLibrary(page_mode=args.page_mode)
-    if args.pz_path:
-        lib.add_from_pz_path(args.pz_path, args.debug)
-    for pack_path in args.packs:
-        lib.add_pack(pack_path, args.debug)
-    if args.test_plants:
-        lib.config_plants({
-            'snow': True,
-            'flower': True,
-            'large_bush': True,
-            'tree_size': 3,
-            'jumbo_tree_size': 5,
-        })
-    lib.save_all(args.output, args.mp)
-    # lib.save_pages(args.output)
+    if args.page_mode or args.test_plants:
+        lib = TextureLibrary(page_mode=args.page_mode)
+        if args.pz_path:
+            lib.add_from_pz_path(args.pz_path, args.debug)
+        for pack_path in args.packs:
+            lib.add_pack(pack_path, args.debug)
+        if args.test_plants:
+            lib.config_plants({
+                'snow': True,
+                'flower': True,
+                'large_bush': True,
+                'tree_size': 3,
+                'jumbo_tree_size': 5,
+            })
+        lib.save_all(args.output, args.mp, args.atlas)
+        # lib.save_pages(args.output)
+    else:
+        packs = pz_packs(args.pz_path) if args.pz_path else []
+        unpack_packs(packs + args.packs, args.output, args.mp, args.atlas,
+                     args.debug)
@@ -0,0 +1,92 @@
+import os
+import mmap
+import struct
+from PIL import Image
+from . import util
+
+# texture atlas file layout (little endian):
+#     magic 'PZTA', version, texture count, data offset (uint64)
+#     index, one entry per texture:
+#         name (uint32 length + utf8), data offset (uint64), w, h, ox, oy
+#     texture data, raw RGBA rows of each texture, starting at data offset
+# textures are stored trimmed and contiguous, so a texture can be used
+# directly as an image view over the memory mapped file
+MAGIC = b'PZTA'
+VERSION = 1
+ATLAS_NAME = 'textures.atlas'
+HEADER = struct.Struct('<4sIIQ')
+ENTRY = struct.Struct('<Qiiii')
+DATA_ALIGN = 4096
+
+
+def atlas_path(path):
+    return os.path.join(path, ATLAS_NAME)
+
+
+class TextureAtlas(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, data_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            self.data.close()
+            raise ValueError('Invalid texture atlas: {}'.format(path))
+        self.view = memoryview(self.data)
+        self.index = {}
+        pos = HEADER.size
+        for i in range(count):
+            name, pos = util.read_bytes_with_length(self.data, pos)
+            offset, w, h, ox, oy = ENTRY.unpack_from(self.data, pos)
+            pos += ENTRY.size
+            self.index[name.decode('utf8')] = (data_offset + offset,
+                                               w, h, ox, oy)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return self.index.keys()
+
+    def get_image(self, name):
+        # (im, (ox, oy)), im is a read only view of the atlas
+        offset, w, h, ox, oy = self.index[name]
+        if w == 0 or h == 0:
+            return Image.new('RGBA', (0, 0)), (0, 0)
+        buf = self.view[offset: offset + 4 * w * h]
+        im = Image.frombuffer('RGBA', (w, h), buf, 'raw', 'RGBA', 0, 1)
+        return im, (ox, oy)
+
+    def close(self):
+        # images returned by get_image must be released before closing
+        self.view.release()
+        self.data.close()
+
+
+def save_atlas(path, textures):
+    # textures: list of (name, im, ox, oy), im trimmed to its bounding box
+    entries = []
+    index = []
+    size = 0
+    for name, im, ox, oy in textures:
+        w, h = im.size
+        name = name.encode('utf8')
+        index.append(struct.pack('<I', len(name)) + name +
+                     ENTRY.pack(size, w, h, ox, oy))
+        entries.append(im)
+        size += 4 * w * h
+    index = b''.join(index)
+    data_offset = HEADER.size + len(index)
+    data_offset += -data_offset % DATA_ALIGN
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), data_offset))
+        f.write(index)
+        f.write(b'\x00' * (data_offset - HEADER.size - len(index)))
+        for im in entries:
+            if im.mode != 'RGBA':
+                im = im.convert('RGBA')
+            f.write(im.tobytes())
+    if os.path.isfile(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
@@ -0,0 +1,223 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+# render state of each tile of a DZI output, replacing the .pending and
+# .empty marker files, see docs/designs/incremental_update.md
+# a tile is PENDING while rendered, then EMPTY (no content on any layer) or
+# DONE with the layers holding content, mtime is when the state was set
+# the manifest records each tile file written (stat and md5 of the file),
+# stores of version 0 have no manifest and need a scan of the tile files
+# files written or removed while rendering a tile are recorded with its
+# next state, in the same transaction
+DB_NAME = 'tile_state.db'
+VERSION = 1
+PENDING = 0
+EMPTY = 1
+DONE = 2
+TILE_EXTS = ['png', 'webp', 'jpg']
+TILE_PATTERN = re.compile(r'^(\d+)_(\d+)\.({})$'.format('|'.join(TILE_EXTS)))
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS tile_state ('
+    'level INTEGER, x INTEGER, y INTEGER, state INTEGER, mtime REAL, '
+    'layers TEXT, PRIMARY KEY (level, x, y)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS tile_manifest ('
+    'level INTEGER, layer INTEGER, x INTEGER, y INTEGER, ext TEXT, '
+    'mtime REAL, size INTEGER, hash BLOB, '
+    'PRIMARY KEY (level, layer, x, y, ext)) WITHOUT ROWID',
+]
+
+
+def encode_layers(layers):
+    return ','.join(str(layer) for layer in layers)
+
+
+def decode_layers(text):
+    return tuple(int(layer) for layer in text.split(',')) if text else ()
+
+
+def digest(data):
+    # hash of a tile file in the manifest
+    return hashlib.md5(data).digest()
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return digest(f.read())
+
+
+def scan_folder(args):
+    # {(level, layer, x, y, ext): (mtime, size)} of the tile files of a
+    # level folder, called in parallel for each folder
+    level, layer, path = args
+    files = {}
+    if not os.path.isdir(path):
+        return files
+    for name in os.listdir(path):
+        match = TILE_PATTERN.match(name)
+        if not match:
+            continue
+        st = os.stat(os.path.join(path, name))
+        x, y, ext = match.groups()
+        files[(level, layer, int(x), int(y), ext)] = st.st_mtime, st.st_size
+    return files
+
+
+class TileState(object):
+    # written by the worker processes and their writer threads, each
+    # process opens its own connection on first use
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # (level, x, y) -> {(level, layer, x, y, ext): (mtime, size, hash)
+        #                   or None when removed} of the tiles being rendered
+        self.files = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['db'] = None
+        state['pid'] = None
+        state['lock'] = None
+        state['files'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def connect(self):
+        # called with the lock held
+        if self.db is not None and self.pid == os.getpid():
+            return self.db
+        self.pid = os.getpid()
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                             check_same_thread=False)
+        # commits in WAL mode are not synced, a state lost on a power
+        # failure only makes its tile render again
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for sql in SCHEMA:
+            db.execute(sql)
+        self.db = db
+        return db
+
+    def close(self):
+        # a connection must not be carried over to forked workers
+        with self.lock:
+            if self.db is not None and self.pid == os.getpid():
+                self.db.close()
+            self.db = None
+
+    def write_files(self, db, tiles):
+        # record the files of tiles (see add_file), called in a transaction
+        # with the lock held
+        rows = []
+        removed = []
+        for tile in tiles:
+            for key, value in self.files.pop(tile, {}).items():
+                if value is None:
+                    removed.append(key)
+                else:
+                    rows.append(key + value)
+        db.executemany('DELETE FROM tile_manifest WHERE level = ? AND '
+                       'layer = ? AND x = ? AND y = ? AND ext = ?', removed)
+        db.executemany('INSERT OR REPLACE INTO tile_manifest '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def set(self, level, x, y, state, layers=()):
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            self.write_files(db, [(level, x, y)])
+            db.execute(
+                'INSERT OR REPLACE INTO tile_state VALUES (?, ?, ?, ?, ?, ?)',
+                (level, x, y, state, time.time(), encode_layers(layers)))
+            db.execute('COMMIT')
+
+    def set_many(self, rows):
+        # rows: (level, x, y, state, mtime, layers), in one transaction
+        rows = [row[:5] + (encode_layers(row[5]),) for row in rows]
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR REPLACE INTO tile_state '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.execute('COMMIT')
+
+    def forget(self, tiles):
+        # tiles: (level, x, y)
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            self.write_files(db, tiles)
+            db.executemany('DELETE FROM tile_state WHERE level = ? AND '
+                           'x = ? AND y = ?', tiles)
+            db.execute('COMMIT')
+
+    def outdated(self):
+        with self.lock:
+            version = self.connect().execute('PRAGMA user_version').fetchone()
+        return version[0] < VERSION
+
+    def set_current(self):
+        with self.lock:
+            self.connect().execute('PRAGMA user_version = {}'.format(VERSION))
+
+    def add_file(self, tile, key, path, digest=None):
+        # a file written while rendering tile (level, x, y), recorded with
+        # the next state of the tile
+        # key: (level, layer, x, y, ext) of the file
+        # digest: md5 of the file content, read from the file when None
+        st = os.stat(path)
+        if digest is None:
+            digest = file_digest(path)
+        with self.lock:
+            self.files.setdefault(tile, {})[key] = (
+                st.st_mtime, st.st_size, digest)
+
+    def remove_file(self, tile, key):
+        # a file removed while rendering tile, see add_file
+        with self.lock:
+            self.files.setdefault(tile, {})[key] = None
+
+    def set_files(self, rows):
+        # rows: (level, layer, x, y, ext, mtime, size, hash)
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR REPLACE INTO tile_manifest '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            db.execute('COMMIT')
+
+    def forget_files(self, files):
+        # files: (level, layer, x, y, ext)
+        with self.lock:
+            db = self.connect()
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('DELETE FROM tile_manifest WHERE level = ? AND '
+                           'layer = ? AND x = ? AND y = ? AND ext = ?', files)
+            db.execute('COMMIT')
+
+    def load_files(self):
+        # [(level, layer, x, y, ext, mtime, size, hash)] of all the files
+        with self.lock:
+            return self.connect().execute(
+                'SELECT level, layer, x, y, ext, mtime, size, hash '
+                'FROM tile_manifest').fetchall()
+
+    def load(self):
+        # [(level, x, y, state, mtime, layers)] of all the tiles
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT level, x, y, state, mtime, layers FROM tile_state'
+            ).fetchall()
+        return [row[:5] + (decode_layers(row[5]),) for row in rows]
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import array
 import shutil
 import struct
 import os
@@ -17,15 +18,35 @@ def read_line(data, pos):
 
 
 def read_uint8(data, pos):
-    return struct.unpack('B', data[pos: pos+1])[0], pos + 1
+    return struct.unpack_from('B', data, pos)[0], pos + 1
 
 
 def read_uint32(data, pos):
-    return struct.unpack('I', data[pos: pos+4])[0], pos + 4
+    return struct.unpack_from('I', data, pos)[0], pos + 4
 
 
 def read_int32(data, pos):
-    return struct.unpack('i', data[pos: pos+4])[0], pos + 4
+    return struct.unpack_from('i', data, pos)[0], pos + 4
+
+
+def read_int32_array(data, pos=0):
+    # bulk decode data[pos:] as native int32, trailing bytes are dropped
+    end = pos + ((len(data) - pos) & ~3)
+    ints = array.array('i')
+    if hasattr(ints, 'frombytes'):
+        ints.frombytes(data[pos: end])
+    else:
+        ints.fromstring(data[pos: end])  # python 2
+    return ints
+
+
+def int32_view(data):
+    # zero-copy native int32 view of a buffer (e.g. mmap) when supported
+    end = len(data) & ~3
+    view = memoryview(data)
+    if hasattr(view, 'cast'):
+        return view[:end].cast('i')
+    return read_int32_array(data)  # python 2
 
 
 def read_bytes_with_length(data, pos):
@@ -33,6 +54,100 @@ def read_bytes_with_length(data, pos):
     return data[pos + 4: pos + 4 + length], pos + 4 + length
 
 
+class BinaryReader(object):
+    # cursor over a buffer (bytes, mmap or memoryview) in native byte order
+    # like the read_* functions above, values are decoded in place with
+    # struct.unpack_from and the cursor is advanced instead of returning
+    # (value, pos) tuples
+    UINT8 = struct.Struct('B')
+    INT32 = struct.Struct('i')
+    UINT32 = struct.Struct('I')
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def skip(self, size):
+        self.pos += size
+
+    def unpack(self, fmt):
+        # values of a struct.Struct at the cursor
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def uint8(self):
+        value = self.UINT8.unpack_from(self.data, self.pos)[0]
+        self.pos += 1
+        return value
+
+    def uint32(self):
+        value = self.UINT32.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def int32(self):
+        value = self.INT32.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def values(self, code, count):
+        # tuple of count values of the same struct type code, e.g. 'i'
+        if count <= 0:
+            return ()
+        fmt = '{}{}'.format(count, code)
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def records(self, code, width, count):
+        # list of count tuples of width values of the same type code
+        values = iter(self.values(code, width * count))
+        return list(zip(*[values] * width))
+
+    def bytes(self, size):
+        start = self.pos
+        self.pos += size
+        return self.data[start: self.pos]
+
+    def uint8_list(self, count):
+        return list(bytearray(self.bytes(count)))
+
+    def bytes_with_length(self):
+        return self.bytes(self.uint32())
+
+    def match(self, magic):
+        # skip magic if the data at the cursor starts with it
+        end = self.pos + len(magic)
+        if self.data[self.pos: end] != magic:
+            return False
+        self.pos = end
+        return True
+
+    def until(self, pattern):
+        end = self.data.find(pattern, self.pos)
+        if end < 0:
+            raise ValueError('{!r} not found'.format(pattern))
+        return self.bytes(end + len(pattern) - self.pos)
+
+    def line(self):
+        return self.until(b'\n')[:-1]
+
+    def lines(self, count):
+        # list of count lines, split at once
+        if count <= 0:
+            return []
+        end = self.pos - 1
+        for i in range(count):
+            end = self.data.find(b'\n', end + 1)
+            if end < 0:
+                raise ValueError('{} lines not found'.format(count))
+        return bytes(self.bytes(end + 1 - self.pos)).split(b'\n')[:-1]
+
+
 def ensure_folder(path):
     if not os.path.exists(path):
         try:
@@ -5,16 +5,14 @@ sys.path.append(os.path.join(_BASE_DIR, '..'))
 _DEFAULT_CONF = os.path.join(_BASE_DIR, '../conf/conf.yaml')
 try:
     import main
-    from pzmap2dzi import lotheader, texture
+    from pzmap2dzi import coverage, lotheader, texture
 except ImportError:
     raise
 
 
 def get_used_tiles(path):
-    headers = lotheader.load_all_headers(path)
-    used = set()
-    for header in headers.values():
-        used.update(header['tiles'])
+    cells = lotheader.scan_headers(path)
+    used = coverage.tile_counts(path, cells, os.cpu_count() or 1)
     return sorted(list(used))
 
 
@@ -0,0 +1,88 @@
+import sys
+import os
+import math
+import random
+import timeit
+import argparse
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(_BASE_DIR, '..', '..'))
+from pzmap2dzi import downsample
+
+
+def synthetic_tile(size, seed):
+    # transparent tile with opaque and translucent diamonds, like a render
+    rng = random.Random(seed)
+    im = Image.new('RGBA', (size, size))
+    draw = ImageDraw.Draw(im)
+    for i in range(size // 4):
+        x, y = rng.randrange(size), rng.randrange(size)
+        r = rng.randrange(4, max(5, size // 16))
+        color = tuple(rng.randrange(256) for c in range(3))
+        alpha = 255 if rng.random() < 0.8 else rng.randrange(32, 224)
+        draw.polygon([(x, y - r), (x + 2 * r, y), (x, y + r), (x - 2 * r, y)],
+                     fill=color + (alpha,))
+    return im
+
+
+def merge_lanczos(children, size):
+    tile = Image.new('RGBA', (size << 1, size << 1))
+    for (i, j), im in children:
+        tile.paste(im, (size * i, size * j))
+    tile.thumbnail((size, size), Image.LANCZOS)
+    out = Image.new('RGBA', (size, size))
+    out.paste(tile, (0, 0))
+    return out
+
+
+def merge_reduce(children, size, reducer):
+    half = size >> 1
+    out = Image.new('RGBA', (size, size))
+    for (i, j), im in children:
+        out.paste(reducer(im), (half * i, half * j))
+    return out
+
+
+def difference(a, b):
+    # (mean, max) absolute difference of the alpha premultiplied channels,
+    # and PSNR, colors of (almost) transparent pixels are not compared
+    diff = ImageChops.difference(a.convert('RGBa'), b.convert('RGBa'))
+    stat = ImageStat.Stat(diff)
+    mean = sum(stat.mean) / 4
+    peak = max(hi for lo, hi in stat.extrema)
+    mse = sum(stat.sum2) / (4 * a.size[0] * a.size[1])
+    psnr = 10 * math.log10(255 * 255 / mse) if mse else float('inf')
+    return mean, peak, psnr
+
+
+def bench(size, number):
+    children = [((i, j), synthetic_tile(size, j + i * 2))
+                for i in (0, 1) for j in (0, 1)]
+    methods = [('lanczos', lambda: merge_lanczos(children, size))]
+    for name in downsample.METHODS[1:]:
+        if name == 'numpy' and downsample.numpy is None:
+            print('numpy not found, skip numpy')
+            continue
+        reducer = downsample.get_reducer(name)
+        methods.append((name, lambda r=reducer: merge_reduce(
+            children, size, r)))
+    print('tile size: {}, 4 children per merge'.format(size))
+    reference = methods[0][1]()
+    base = None
+    for name, merge in methods:
+        t = min(timeit.repeat(merge, number=number, repeat=3)) / number
+        base = base or t
+        mean, peak, psnr = difference(reference, merge())
+        print('{:8s} {:8.2f} ms {:6.2f}x  diff mean {:.3f} max {} '
+              'psnr {:.1f} dB'.format(name, t * 1000, base / t,
+                                     mean, peak, psnr))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='pyramid downsampling micro-benchmark')
+    parser.add_argument('-s', '--tile-size', type=int, default=1024)
+    parser.add_argument('-n', '--number', type=int, default=5)
+    args = parser.parse_args()
+    bench(args.tile_size, args.number)
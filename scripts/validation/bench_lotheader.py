@@ -0,0 +1,187 @@
+import sys
+import os
+import random
+import shutil
+import struct
+import tempfile
+import timeit
+import argparse
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(_BASE_DIR, '..', '..'))
+from pzmap2dzi import lotheader
+
+
+# parser using per value slices and (value, pos) tuples, as lotheaders
+# were read before util.BinaryReader, kept here as the baseline
+def _read_line(data, pos):
+    end = data.index(b'\n', pos)
+    return data[pos: end], end + 1
+
+
+def _read_uint8(data, pos):
+    return struct.unpack('B', data[pos: pos + 1])[0], pos + 1
+
+
+def _read_uint32(data, pos):
+    return struct.unpack('I', data[pos: pos + 4])[0], pos + 4
+
+
+def _read_int32(data, pos):
+    return struct.unpack('i', data[pos: pos + 4])[0], pos + 4
+
+
+def _calc_room_bound(room):
+    for rect in room['rects']:
+        x, y, w, h = rect
+        room['xmin'] = min(room.get('xmin', x), x)
+        room['xmax'] = max(room.get('xmax', x + w), x + w)
+        room['ymin'] = min(room.get('ymin', y), y)
+        room['ymax'] = max(room.get('ymax', y + h), y + h)
+
+
+def _read_room(data, pos):
+    room = {}
+    room['name'], pos = _read_line(data, pos)
+    room['layer'], pos = _read_int32(data, pos)
+    rect_num, pos = _read_uint32(data, pos)
+    rects = []
+    room['area'] = 0
+    for i in range(rect_num):
+        x, pos = _read_int32(data, pos)
+        y, pos = _read_int32(data, pos)
+        w, pos = _read_int32(data, pos)
+        h, pos = _read_int32(data, pos)
+        room['area'] += w * h
+        rects.append((x, y, w, h))
+    room['rects'] = rects
+    _calc_room_bound(room)
+    meta_num, pos = _read_uint32(data, pos)
+    metas = []
+    for i in range(meta_num):
+        meta_type, pos = _read_int32(data, pos)
+        x, pos = _read_int32(data, pos)
+        y, pos = _read_int32(data, pos)
+        metas.append((meta_type, x, y))
+    room['objects'] = metas
+    return room, pos
+
+
+def legacy_parse(data):
+    header = {}
+    version, pos = _read_uint32(data, 4)
+    header.update(lotheader.VERSION_LIMITATIONS[version])
+    header['version'] = version
+    tile_num, pos = _read_uint32(data, pos)
+    tiles = []
+    for i in range(tile_num):
+        name, pos = _read_line(data, pos)
+        tiles.append(name.decode('utf8').strip())
+    header['tiles'] = tiles
+    header['width'], pos = _read_uint32(data, pos)
+    header['height'], pos = _read_uint32(data, pos)
+    minlayer, pos = _read_int32(data, pos)
+    maxlayer, pos = _read_int32(data, pos)
+    header['minlayer'] = max(minlayer, header['MIN_LAYER'])
+    header['maxlayer'] = min(maxlayer + 1, header['MAX_LAYER'])
+    room_num, pos = _read_uint32(data, pos)
+    rooms = []
+    for i in range(room_num):
+        room, pos = _read_room(data, pos)
+        room['id'] = i
+        rooms.append(room)
+    header['rooms'] = rooms
+    building_num, pos = _read_uint32(data, pos)
+    buildings = []
+    for i in range(building_num):
+        room_num, pos = _read_uint32(data, pos)
+        building = {'rooms': []}
+        for j in range(room_num):
+            room_id, pos = _read_uint32(data, pos)
+            building['rooms'].append(room_id)
+        building['id'] = i
+        buildings.append(building)
+    header['buildings'] = buildings
+    size = header['CELL_SIZE_IN_BLOCKS']
+    zpop = []
+    for x in range(size):
+        line = []
+        for y in range(size):
+            pop, pos = _read_uint8(data, pos)
+            line.append(pop)
+        zpop.append(line)
+    header['zpop'] = zpop
+    return header
+
+
+def synthetic_lotheader(tiles, rooms, buildings, seed=0):
+    # a B42 lotheader with random content
+    rng = random.Random(seed)
+    size = lotheader.VERSION_LIMITATIONS[1]['CELL_SIZE_IN_BLOCKS']
+    out = [b'LOTH', struct.pack('I', 1), struct.pack('I', tiles)]
+    for i in range(tiles):
+        out.append('tileset_{}_{}\n'.format(i // 64, i % 64).encode('utf8'))
+    out.append(struct.pack('IIii', 256, 256, -1, 3))
+    out.append(struct.pack('I', rooms))
+    for i in range(rooms):
+        out.append('room{}\n'.format(rng.randrange(50)).encode('utf8'))
+        rects = rng.randrange(1, 6)
+        out.append(struct.pack('iI', rng.randrange(-1, 4), rects))
+        for j in range(rects):
+            out.append(struct.pack(
+                '4i', rng.randrange(256), rng.randrange(256),
+                rng.randrange(1, 20), rng.randrange(1, 20)))
+        objects = rng.randrange(8)
+        out.append(struct.pack('I', objects))
+        for j in range(objects):
+            out.append(struct.pack('3i', rng.randrange(10),
+                                   rng.randrange(256), rng.randrange(256)))
+    out.append(struct.pack('I', buildings))
+    for i in range(buildings):
+        ids = rng.sample(range(rooms), min(rooms, rng.randrange(1, 8)))
+        out.append(struct.pack('I{}I'.format(len(ids)), len(ids), *ids))
+    out.append(bytes(bytearray(rng.randrange(256)
+                               for i in range(size * size))))
+    return b''.join(out)
+
+
+def bench(tiles, rooms, buildings, number):
+    path = tempfile.mkdtemp()
+    try:
+        data = synthetic_lotheader(tiles, rooms, buildings)
+        with open(os.path.join(path, '0_0.lotheader'), 'wb') as f:
+            f.write(data)
+        print('lotheader: {} bytes, {} tiles, {} rooms, {} buildings'.format(
+            len(data), tiles, rooms, buildings))
+
+        def legacy():
+            with open(os.path.join(path, '0_0.lotheader'), 'rb') as f:
+                return legacy_parse(f.read())
+
+        def current():
+            return lotheader.load_lotheader(path, 0, 0)
+
+        header = current()
+        expected = legacy()
+        for key in expected:
+            if header[key] != expected[key]:
+                print('Mismatch: {}'.format(key))
+                return
+        old = min(timeit.repeat(legacy, number=number, repeat=3)) / number
+        new = min(timeit.repeat(current, number=number, repeat=3)) / number
+        print('read_* tuples: {:.3f} ms'.format(old * 1000))
+        print('BinaryReader:  {:.3f} ms'.format(new * 1000))
+        print('speedup: {:.2f}x'.format(old / new))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='lotheader parsing micro-benchmark')
+    parser.add_argument('-t', '--tiles', type=int, default=3000)
+    parser.add_argument('-r', '--rooms', type=int, default=400)
+    parser.add_argument('-b', '--buildings', type=int, default=120)
+    parser.add_argument('-n', '--number', type=int, default=50)
+    args = parser.parse_args()
+    bench(args.tiles, args.rooms, args.buildings, args.number)
@@ -0,0 +1,186 @@
+import sys
+import os
+import random
+import shutil
+import struct
+import tempfile
+import argparse
+from PIL import Image
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(_BASE_DIR, '..', '..'))
+from pzmap2dzi import binfile, lru, texture_atlas, util
+
+# round trips of the binary formats: lotpack blocks decoded by
+# binfile.read_block and binfile.read_block_flat, util.BinaryReader,
+# texture atlases and lru.BudgetLRU
+# prints the failed checks, exit code 1 if any
+
+
+FAILED = []
+
+
+def check(name, ok):
+    if not ok:
+        FAILED.append(name)
+        print('FAILED: {}'.format(name))
+
+
+def random_squares(rng, count, fill):
+    # tile ids of each square, None for an empty square
+    squares = []
+    for i in range(count):
+        if rng.random() < fill:
+            squares.append([rng.randrange(1000)
+                            for j in range(rng.randrange(1, 6))])
+        else:
+            squares.append(None)
+    return squares
+
+
+def encode_block(squares, room=7):
+    # lotpack block: [-1, n] for a run of n empty squares,
+    # [count, room id, tile ids...] with count = tiles + 1 otherwise
+    ints = []
+    i = 0
+    while i < len(squares):
+        if squares[i] is None:
+            j = i
+            while j < len(squares) and squares[j] is None:
+                j += 1
+            ints += [-1, j - i]
+            i = j
+        else:
+            ints += [len(squares[i]) + 1, room] + squares[i]
+            i += 1
+    return struct.pack('{}i'.format(len(ints)), *ints)
+
+
+def check_block(rng, block_size, layer_range, fill):
+    minlayer, maxlayer = layer_range
+    square_per_layer = block_size * block_size
+    squares = random_squares(rng, (maxlayer - minlayer) * square_per_layer,
+                             fill)
+    data = encode_block(squares)
+    name = 'block {} {} fill {}'.format(block_size, layer_range, fill)
+
+    reader = util.BinaryReader(data)
+    nested = binfile.read_block(reader, block_size, layer_range,
+                                binfile.lotpack_data_parser)
+    check(name + ': read_block consumes the block', reader.pos == len(data))
+    ok = True
+    for z in range(minlayer, maxlayer):
+        for x in range(block_size):
+            for y in range(block_size):
+                i = ((z - minlayer) * block_size + x) * block_size + y
+                layer = nested[z]
+                row = layer[x] if layer else None
+                tiles = row[y] if row else None
+                ok = ok and tiles == squares[i]
+    check(name + ': read_block', ok)
+
+    ints = util.read_int32_array(data)
+    decode_ranges = [None, (minlayer, minlayer + 1), (0, maxlayer),
+                     (maxlayer - 1, maxlayer + 4)]
+    for decode_range in decode_ranges:
+        (offsets, tiles), idx = binfile.read_block_flat(
+            ints, 0, block_size, layer_range, decode_range)
+        lo, hi = decode_range if decode_range else layer_range
+        lo = min(max(lo, minlayer), maxlayer)
+        hi = min(max(hi, lo), maxlayer)
+        ok = len(offsets) == (hi - lo) * square_per_layer + 1
+        for z in range(lo, hi):
+            for k in range(square_per_layer):
+                i = (z - lo) * square_per_layer + k
+                expected = squares[(z - minlayer) * square_per_layer + k]
+                flat = list(tiles[offsets[i]: offsets[i + 1]]) or None
+                ok = ok and flat == expected
+        check('{}: read_block_flat {}'.format(name, decode_range), ok)
+        if decode_range is None:
+            check(name + ': read_block_flat consumes the block',
+                  idx == len(ints))
+
+
+def check_reader():
+    data = (struct.pack('=BIi', 200, 4000000000, -5) +
+            struct.pack('3i', 1, 2, 3) + struct.pack('4i', 1, 2, 3, 4) +
+            struct.pack('I', 5) + b'hello' + b'MAGC' +
+            b'head\xef\xbe\xad\xdetail')
+    reader = util.BinaryReader(data)
+    check('reader uint8', reader.uint8() == 200)
+    check('reader uint32', reader.uint32() == 4000000000)
+    check('reader int32', reader.int32() == -5)
+    check('reader values', reader.values('i', 3) == (1, 2, 3))
+    check('reader records', reader.records('i', 2, 2) == [(1, 2), (3, 4)])
+    check('reader bytes_with_length', reader.bytes_with_length() == b'hello')
+    check('reader match other', not reader.match(b'XXXX'))
+    check('reader match', reader.match(b'MAGC'))
+    check('reader until',
+          reader.until(b'\xef\xbe\xad\xde') == b'head\xef\xbe\xad\xde')
+    check('reader end', reader.bytes(4) == b'tail' and
+          reader.pos == len(data))
+
+
+def check_atlas(rng):
+    path = tempfile.mkdtemp()
+    try:
+        textures = []
+        for i in range(20):
+            w, h = rng.randrange(1, 80), rng.randrange(1, 80)
+            im = Image.frombytes('RGBA', (w, h), bytes(bytearray(
+                rng.randrange(256) for j in range(4 * w * h))))
+            textures.append(('tex_{}'.format(i), im, rng.randrange(-64, 64),
+                             rng.randrange(-64, 64)))
+        textures.append(('empty', Image.new('RGBA', (0, 0)), 0, 0))
+        atlas_path = texture_atlas.atlas_path(path)
+        texture_atlas.save_atlas(atlas_path, textures)
+        atlas = texture_atlas.TextureAtlas(atlas_path)
+        check('atlas names', sorted(atlas.names()) ==
+              sorted(name for name, im, ox, oy in textures))
+        ok = True
+        for name, im, ox, oy in textures:
+            loaded, offset = atlas.get_image(name)
+            ok = ok and loaded.size == im.size
+            if im.size[0] and im.size[1]:
+                ok = (ok and offset == (ox, oy) and
+                      loaded.tobytes() == im.tobytes())
+            loaded = None
+        check('atlas textures', ok)
+        atlas.close()
+        check('atlas temporary file removed', os.listdir(path) ==
+              [texture_atlas.ATLAS_NAME])
+    finally:
+        shutil.rmtree(path)
+
+
+def check_lru():
+    cache = lru.BudgetLRU(10, len)
+    cache.put('a', 'xxxx')
+    cache.put('b', 'xxxx')
+    check('lru get', cache.get('a') == (True, 'xxxx'))
+    # 'b' is the least recently used
+    cache.put('c', 'xxxx')
+    check('lru evict', cache.get('b') == (False, None) and
+          cache.get('a')[0] and cache.get('c')[0])
+    check('lru budget', cache.used == 8)
+    cache.put('d', 'x' * 11)
+    check('lru oversized', cache.get('d') == (False, None))
+    check('lru counters', (cache.hits, cache.misses) == (3, 2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='binary format round trips')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-n', '--blocks', type=int, default=20)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    for i in range(args.blocks):
+        layer_range = rng.choice([(0, 8), (-32, 32), (-1, 3)])
+        check_block(rng, rng.choice([8, 10]), layer_range,
+                    rng.choice([0.0, 0.05, 0.5, 1.0]))
+    check_reader()
+    check_atlas(rng)
+    check_lru()
+    print('{} checks failed'.format(len(FAILED)) if FAILED else 'All checks passed')
+    sys.exit(1 if FAILED else 0)
@@ -0,0 +1,136 @@
+import sys
+import os
+import io
+import shutil
+import tempfile
+from PIL import Image
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(_BASE_DIR, '..', '..'))
+from pzmap2dzi import dedup, scheduling, tile_state
+
+# resume logic of a render: tile states and manifest (tile_state.TileState),
+# failed writes of scheduling.TileWriter staying pending and hardlinks of
+# dedup.Dedup, on a temporary output folder
+# prints the failed checks, exit code 1 if any
+
+
+FAILED = []
+
+
+def check(name, ok):
+    if not ok:
+        FAILED.append(name)
+        print('FAILED: {}'.format(name))
+
+
+def encode(im, path):
+    # replaces path like DZI.encode_tile, returns the manifest digest
+    data = io.BytesIO()
+    im.save(data, 'PNG')
+    data = data.getvalue()
+    tmp = dedup.temp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    dedup.replace_file(tmp, path)
+    return tile_state.digest(data)
+
+
+def check_states(path):
+    db_path = os.path.join(path, tile_state.DB_NAME)
+    states = tile_state.TileState(db_path)
+    check('new store outdated', states.outdated())
+    states.set(3, 1, 2, tile_state.PENDING)
+    tile = os.path.join(path, '1_2.png')
+    digest = encode(Image.new('RGBA', (4, 4), (255, 0, 0, 255)), tile)
+    states.add_file((3, 1, 2), (3, 0, 1, 2, 'png'), tile, digest)
+    states.add_file((3, 1, 2), (3, 1, 1, 2, 'png'), tile)
+    check('manifest waits for the tile state', states.load_files() == [])
+    states.set(3, 1, 2, tile_state.DONE, (0, 1))
+    states.set_current()
+    states.close()
+
+    # reopened as by the next run
+    states = tile_state.TileState(db_path)
+    check('state version', not states.outdated())
+    rows = states.load()
+    check('tile state', len(rows) == 1 and rows[0][:4] == (3, 1, 2,
+          tile_state.DONE) and rows[0][5] == (0, 1))
+    files = states.load_files()
+    st = os.stat(tile)
+    check('manifest rows', sorted(row[:5] for row in files) ==
+          [(3, 0, 1, 2, 'png'), (3, 1, 1, 2, 'png')])
+    check('manifest stat and digest', all(
+        row[5:] == (st.st_mtime, st.st_size, tile_state.file_digest(tile))
+        for row in files))
+
+    # a removed file is recorded with the next state of the tile
+    states.remove_file((3, 1, 2), (3, 1, 1, 2, 'png'))
+    states.set(3, 1, 2, tile_state.DONE, (0,))
+    check('removed file', [row[:5] for row in states.load_files()] ==
+          [(3, 0, 1, 2, 'png')])
+    states.forget([(3, 1, 2)])
+    states.forget_files([(3, 0, 1, 2, 'png')])
+    check('forget', states.load() == [] and states.load_files() == [])
+    states.close()
+
+
+def check_writer(path):
+    states = tile_state.TileState(os.path.join(path, tile_state.DB_NAME))
+    writer = scheduling.TileWriter(2, 2)
+    good = os.path.join(path, '0_0.png')
+    im = Image.new('RGBA', (4, 4), (0, 255, 0, 255))
+
+    def fail():
+        raise IOError('disk full')
+
+    print('a failed write of tile (5, 1, 0) is expected below')
+    for key, func, args in [((5, 0, 0), encode, (im, good)),
+                            ((5, 1, 0), fail, ())]:
+        states.set(key[0], key[1], key[2], tile_state.PENDING)
+        writer.put(key, func, *args)
+        writer.when_done(key, lambda key=key: states.set(
+            key[0], key[1], key[2], tile_state.DONE, (0,)))
+    writer.wait((5, 0, 0))
+    try:
+        writer.wait((5, 1, 0))
+        raised = False
+    except IOError as e:
+        raised = True
+    check('failed write raised by its key', raised)
+    writer.close()
+    rows = dict((row[:3], row[3]) for row in states.load())
+    check('written tile done', rows.get((5, 0, 0)) == tile_state.DONE)
+    check('failed tile pending', rows.get((5, 1, 0)) == tile_state.PENDING)
+    states.close()
+
+
+def check_dedup(path):
+    db = dedup.Dedup(os.path.join(path, dedup.DB_NAME), 'md5')
+    a = Image.new('RGBA', (8, 8), (0, 0, 255, 255))
+    b = Image.new('RGBA', (8, 8), (255, 255, 0, 255))
+    first = os.path.join(path, '0_0.png')
+    second = os.path.join(path, '0_1.png')
+    check('dedup written', db.save(a, 'png', first, encode) is not None)
+    check('dedup linked', db.save(a, 'png', second, encode) is None)
+    check('dedup same inode', os.stat(first).st_ino == os.stat(second).st_ino)
+    data = open(second, 'rb').read()
+    # a linked tile is replaced, never written through
+    db.save(b, 'png', first, encode)
+    check('dedup link kept', open(second, 'rb').read() == data and
+          os.stat(first).st_ino != os.stat(second).st_ino)
+    check('dedup stats', db.stats == [1, 2])
+    check('dedup hash recorded', db.execute(
+        'SELECT hash_algorithm FROM meta_table') == [('md5',)])
+    db.close()
+
+
+if __name__ == '__main__':
+    for func in [check_states, check_writer, check_dedup]:
+        path = tempfile.mkdtemp()
+        try:
+            func(path)
+        finally:
+            shutil.rmtree(path)
+    print('{} checks failed'.format(len(FAILED)) if FAILED else 'All checks passed')
+    sys.exit(1 if FAILED else 0)